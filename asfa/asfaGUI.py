@@ -16,7 +16,7 @@ import asfaUtils
 import asfaDownloads
 from asfaModel import DiskFilesModel, SortFilterModel, ShareFilesModel
 from PyQt5.QtCore import (
-    QThreadPool, QTimer, Qt, pyqtSignal
+    QThread, QThreadPool, QTimer, Qt, pyqtSignal
 )
 from PyQt5.QtGui import (
     QIcon,
@@ -96,7 +96,7 @@ class DuplicatesWindow(QWidget):
         QWidget
     """
 
-    def __init__(self, files: Iterable[str], *args):
+    def __init__(self, files: Iterable[str], *args, message="These files already exist in the destination folder:"):
 
         super().__init__(*args)
         self.setObjectName("duplicatesWindow")
@@ -105,7 +105,7 @@ class DuplicatesWindow(QWidget):
 
         vlayout = QVBoxLayout()
 
-        details_label = QLabel("These files already exist in the destination folder:")
+        details_label = QLabel(message)
         details_label.setObjectName("duplicatesTitle")
         list_widget = QListWidget()
         list_widget.setObjectName("duplicatesListWidget")
@@ -132,7 +132,7 @@ class TransferWindow(QWidget):
         super().__init__(*args)
         self.setObjectName("transferWin")
         self.setWindowTitle("Transfering - asfa")
-        self.setFixedSize(400, 150)
+        self.setFixedSize(400, 170)
 
         main_layout = QVBoxLayout()
         btn_layout = QHBoxLayout()
@@ -149,11 +149,14 @@ class TransferWindow(QWidget):
         self.progress_bar.setTextVisible(0)
         self.remaining_files = QLabel("0 Files Remaining", self)
         self.remaining_files.setObjectName("transferRem")
+        self.transfer_rate = QLabel(self)
+        self.transfer_rate.setObjectName("transferRate")
 
         main_layout.addWidget(self.transfer_to)
         main_layout.addWidget(self.percentage_progress)
         main_layout.addWidget(self.progress_bar)
         main_layout.addWidget(self.remaining_files)
+        main_layout.addWidget(self.transfer_rate)
         main_layout.addLayout(btn_layout)
         self.setLayout(main_layout)
 
@@ -167,16 +170,37 @@ class WorkerManager(TransferWindow):
         all workers/runnables are the same
     """
 
-    _workers_progress = {}
     _active_workers = {}
-    _transferred = {}
     all_done = pyqtSignal()
 
     def __init__(self):
         super().__init__()
         # create a threadpool for workers
         self.files_threadpool = QThreadPool()
-        self.files_threadpool.setMaxThreadCount(1)
+        self.files_threadpool.setMaxThreadCount(max(4, QThread.idealThreadCount()))
+        # one queue per device pair, unrelated devices transfer in parallel
+        self.scheduler = asfaUtils.TransferScheduler(self.files_threadpool)
+        # bytes copied per job, sampled by the timer
+        self.counters = asfaUtils.TransferCounters()
+        # throughput and ETA, fed from the counters
+        self.rates = asfaUtils.RateEstimator()
+        # copied files are read back here, while the next files copy
+        self.verify_threadpool = QThreadPool()
+        self.verify_threadpool.setMaxThreadCount(1)
+        # job id: number of its files being verified
+        self._verifying = {}
+        self.corrupted = []
+        # small files waiting to be packed into a batch, (task, manifest): [items, size]
+        self._batches = {}
+        # src: {dst folder: task} of every queued file, for `is_valid`
+        self._sources = {}
+        # folders still being listed, their files keep coming in
+        self._planners = set()
+        # mirror manifests to save once their files are copied
+        self._manifests = set()
+        # destination device: a folder on it, synced at the end for some `asfaUtils.DURABILITY` modes
+        self._destinations = {}
+        self._flushing = 0
         self.timer = QTimer()
         self.timer.setInterval(200)
         self.timer.timeout.connect(self.refresh_progress)
@@ -184,94 +208,223 @@ class WorkerManager(TransferWindow):
         self.total_workers = 0
         self.total_size = 0
         self.duplicates = []
+        # files left out because they don't fit on the destination
+        self.skipped = []
         asfaUtils.utils_logger.debug(f"Can transfer {self.files_threadpool.maxThreadCount()} files at a time")
         self.cancel_transfer.clicked.connect(self.cancel)
 
+    def add(self, src, dst, size, task="copy", manifest=None):
+        """ queue a file for transfer, small files are packed into batches """
+        self._sources.setdefault(src, {})[dst] = task
+        if size >= asfaUtils.BATCH_FILE_SIZE:
+            self.enqueue(asfaUtils.Transfer(src, dst, size, task=task, manifest=manifest))
+            return
+        key = (task, manifest)
+        batch = self._batches.setdefault(key, [[], 0])
+        batch[0].append((src, dst, size))
+        batch[1] += size
+        if len(batch[0]) >= asfaUtils.BATCH_MAX_FILES or batch[1] >= asfaUtils.BATCH_MAX_SIZE:
+            del self._batches[key]
+            self.enqueue(asfaUtils.TransferBatch(batch[0], task=task, manifest=manifest))
+
+    def flush(self):
+        """ enqueue the small files still waiting for a batch to fill up """
+        for (task, manifest), (items, size) in self._batches.items():
+            if len(items) == 1:
+                self.enqueue(asfaUtils.Transfer(*items[0], task=task, manifest=manifest))
+            else:
+                self.enqueue(asfaUtils.TransferBatch(items, task=task, manifest=manifest))
+        self._batches.clear()
+
+    def plan(self, planner: asfaUtils.TransferPlanner):
+        """ start listing a folder, the transfers aren't done until it finishes """
+        self._planners.add(planner)
+        if planner.manifest is not None:
+            self._manifests.add(planner.manifest)
+        planner.signals.skipped.connect(self.skipped.extend)
+        planner.finished.connect(lambda: self.planned(planner))
+        planner.start()
+        self.show()
+
+    def planned(self, planner):
+        """ the folder is listed, queue the files left over """
+        self._planners.discard(planner)
+        if planner.running:
+            self.flush()
+        self.check_all_done()
+
     def enqueue(self, worker: asfaUtils.Transfer):
         """ Enqueue a worker to run (at some point) by passing it to the QThreadPool """
 
-        worker.signals.progress.connect(self.receive_progress)
+        worker.track(self.counters)
         worker.signals.finished.connect(self.done)
-        worker.signals.transferred.connect(self.receive_transferred)
         worker.signals.duplicate.connect(self.receive_dups)
+        worker.signals.written.connect(self.receive_written)
         self._active_workers[worker.job_id] = worker
         self.total_workers += 1
         self.total_size += worker.size
-        self.files_threadpool.start(worker)
+        self.scheduler.submit(worker)
+        pair = self.scheduler.device_pair(worker)
+        self.rates.add(pair, worker.size, worker.src, worker.dst)
+        if asfaUtils.durability() in ("periodic", "end") and pair[1] not in self._destinations:
+            self._destinations[pair[1]] = worker.dst if os.path.isdir(worker.dst) else os.path.dirname(worker.dst)
 
         asfaUtils.utils_logger.debug(f"Total size {self.total_size} Bytes")
         self.show()
 
-    def receive_progress(self, job_id, progress):
-        self._workers_progress[job_id] = progress
-
-    def receive_transferred(self, job_id, size):
-        self._transferred[job_id] = size
-
     def receive_dups(self, file):
         self.duplicates.append(file)
 
-    def calculate_progress(self):
+    def receive_written(self, job_id, src, path, digest):
+        """ read `path` back on the verification pool and compare it to `digest` """
+        worker = self._active_workers.get(job_id)
+        if worker is None:
+            # cancelled, the source stays
+            return
+        verification = asfaUtils.Verification(
+            job_id, path, digest, worker.verify, src=src, task=worker.task, manifest=worker.manifest)
+        verification.signals.failed.connect(self.corrupted.append)
+        verification.signals.finished.connect(self.verified)
+        self._verifying[job_id] = self._verifying.get(job_id, 0) + 1
+        self.verify_threadpool.start(verification)
+
+    def verified(self, job_id):
+        left = self._verifying.pop(job_id, 1) - 1
+        if left:
+            self._verifying[job_id] = left
+        self.check_all_done()
+
+    def calculate_progress(self, transferred):
         """ Calculate total progress """
-        if not self._workers_progress or not self.total_workers:
+        if not self.total_size:
             return 0
-        return sum(v for v in self._workers_progress.values()) / self.total_workers
+        return min(100, (transferred * 100) / self.total_size)
 
-    def calculate_transferred(self):
-        if not self._transferred:
-            return 0
-        return sum(v for v in self._transferred.values())
+    def calculate_transferred(self, running):
+        """ bytes of finished jobs plus `running` {device pair: bytes of its started jobs} """
+        return self.counters.finished + sum(running.values())
 
     def refresh_progress(self):
-        """ get and update progress """
-        progress = int(self.calculate_progress())
-        transferred = self.calculate_transferred()
-        rem_size = common.convert_bytes(self.total_size - transferred)
+        """ get and update progress, costs the same however many files are queued """
+        running = {}
+        for pair, worker in self.scheduler.running():
+            running[pair] = running.get(pair, 0) + worker.counters[worker.slot]
+        transferred = self.calculate_transferred(running)
+        progress = int(self.calculate_progress(transferred))
+        rem_size = common.convert_bytes(max(0, self.total_size - transferred))
         rem_files = max(1, len(self._active_workers))
+        self.rates.sample(running, transferred)
+        eta = self.rates.eta()
 
         self.progress_bar.setValue(progress)
         self.percentage_progress.setText(f"{progress}%")
         self.remaining_files.setText(f"{rem_files} remaining ({rem_size})")
+        self.transfer_rate.setText(
+            f"{common.convert_bytes(int(self.rates.current))}/s (peak {common.convert_bytes(int(self.rates.peak))}/s)"
+            f"{f', about {common.convert_seconds(eta)} left' if eta > 0 else ''}")
 
     def done(self, job_id):
-        """ Remove workers when all jobs are done 100% """
+        """ Remove workers when all jobs are done """
         # avoid KeyError
-        if self._active_workers:
-            del self._active_workers[job_id]
-        if all(v == 100 for v in self._workers_progress.values()) and not (self._active_workers):
-            self._workers_progress.clear()
-            self._transferred.clear()
+        worker = self._active_workers.pop(job_id, None)
+        if worker is not None:
+            # finished, skipped or failed, this job has nothing left to copy
+            self.counters.remove(worker.slot, worker.size)
+            self._unindex(worker.items)
+        # let the next worker on the same devices start
+        pair = self.scheduler.release(job_id)
+        if worker is not None and pair is not None:
+            self.rates.finish(pair, worker.size)
+        self.check_all_done()
+
+    def check_all_done(self):
+        """ wrap up when no transfer is running and every copy is verified """
+        if not (self._active_workers or self._verifying or self._planners or self._flushing):
+            if self._destinations:
+                # done copying, wait for the data to reach the devices
+                self.flush_devices()
+                return
+            self.save_manifests()
+            self.scheduler.forget_devices()
+            # running workers keep the old counters, they can't index past the new ones
+            self.counters = asfaUtils.TransferCounters()
+            self.rates.save()
+            self.rates = asfaUtils.RateEstimator()
             self.total_workers = 0
             self.total_size = 0
             self.all_done.emit()
             self.handle_dups()
             self.hide()
 
+    def flush_devices(self):
+        """ sync the destination devices on the verification pool """
+        flush = asfaUtils.Flush(list(self._destinations.values()))
+        self._destinations.clear()
+        self._flushing = 1
+        flush.signals.finished.connect(self.flushed)
+        self.verify_threadpool.start(flush)
+
+    def flushed(self):
+        self._flushing = 0
+        self.check_all_done()
+
     def cancel(self):
         """ cancel transfer """
-        self.files_threadpool.clear()
+        self.scheduler.clear()
+        self.verify_threadpool.clear()
+        # a queued flush may have been dropped with the verifications
+        self._flushing = 0
+        self._verifying.clear()
+        self._batches.clear()
+        self._sources.clear()
+        for planner in self._planners:
+            planner.stop()
+        # files copied before cancelling stay mirrored
+        self.save_manifests()
         for w in self._active_workers.values():
             w.running = 0
         self._active_workers.clear()
         # self.hide()
 
+    def save_manifests(self):
+        for manifest in self._manifests:
+            manifest.save()
+        self._manifests.clear()
+
     def handle_dups(self):
         if self.duplicates:
             self.w = DuplicatesWindow(self.duplicates)
             self.w.setWindowIcon(self.windowIcon())
             self.duplicates.clear()
             self.w.show()
-
-    def is_valid(self, worker):
+        if self.corrupted:
+            self.v = DuplicatesWindow(self.corrupted, message="These copies don't match their source files:")
+            self.v.setWindowIcon(self.windowIcon())
+            self.corrupted.clear()
+            self.v.show()
+        if self.skipped:
+            self.s = DuplicatesWindow(self.skipped, message="These files don't fit on the destination and were skipped:")
+            self.s.setWindowIcon(self.windowIcon())
+            self.skipped.clear()
+            self.s.show()
+
+    def _unindex(self, items):
+        """ forget the files of a finished job """
+        for src, dst, _ in items:
+            dsts = self._sources.get(src)
+            if dsts is not None:
+                dsts.pop(dst, None)
+                if not dsts:
+                    del self._sources[src]
+
+    def is_valid(self, worker_src, worker_dst):
         """ if file is valid for transfer """
-        remaining = {worker.src: (worker.task, worker.src, worker.dst) for worker in self._active_workers.values()}
-        worker_src = worker.src
-        if worker_src in remaining:
-            task, src, dst = remaining[worker_src]
-            if task == "move":
+        dsts = self._sources.get(worker_src)
+        if dsts:
+            if "move" in dsts.values():
                 asfaUtils.utils_logger.info("The same file is being moved, won't be available")
                 return False
-            if (src == worker_src) and (dst == worker.dst):
+            if worker_dst in dsts:
                 asfaUtils.utils_logger.info("The same file is scheduled for the same destination folder")
                 return False
         return True
@@ -282,6 +435,14 @@ class FolderTransferWin(QWidget):
     create a window to popup when a flash-disk is inserted
     """
 
+    # `asfaUtils.QUEUE_ORDERS` key: label
+    orders = {
+        "fifo": "As found",
+        "smallest": "Smallest files first",
+        "largest": "Largest files first",
+        "locality": "Folder by folder",
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.setObjectName("folderPopup")
@@ -306,6 +467,14 @@ class FolderTransferWin(QWidget):
         self.move_flag.clicked.connect(self.vary_remember_disk_states)
         self.recurse = QCheckBox("Transfer source sub-folders")
         self.recurse.setChecked(1)
+        self.mirror = QCheckBox("Only transfer new or changed files")
+        self.mirror.setToolTip("""Remember what was copied from this folder,
+and skip files that haven't changed since.""")
+        self.order = QComboBox()
+        for order, label in self.orders.items():
+            self.order.addItem(label, order)
+        self.order.setCurrentIndex(self.order.findData(asfaUtils.QUEUE_ORDER))
+        self.order.setToolTip("Which files waiting for a drive go first")
         self.remember_disk_option = QCheckBox("Remember these choices (for this disk only)")
         self.remember_disk_option.setToolTip("""Fill these options automatically
 the next time you insert this disk.""")
@@ -344,6 +513,11 @@ the next time you insert this disk.""")
         more_v_layout.addWidget(self.copy_flag)
         more_v_layout.addWidget(self.move_flag)
         more_v_layout.addWidget(self.recurse)
+        more_v_layout.addWidget(self.mirror)
+        order_layout = QHBoxLayout()
+        order_layout.addWidget(QLabel("Order"))
+        order_layout.addWidget(self.order, 1)
+        more_v_layout.addLayout(order_layout)
         more_v_layout.addWidget(self.remember_disk_option)
 
         self.left_v_layout.addWidget(left_title, alignment=Qt.AlignTop)
@@ -370,6 +544,10 @@ the next time you insert this disk.""")
         else:
             self.remember_disk_option.setChecked(False)
             self.remember_disk_option.setDisabled(True)
+        # moved files leave nothing to mirror
+        self.mirror.setEnabled(self.copy_flag.isChecked())
+        if not self.copy_flag.isChecked():
+            self.mirror.setChecked(False)
 
     def create_last_column(self, size_exts: Iterable):
         """ create checkboxes for file extensions available in dir """
@@ -388,7 +566,7 @@ the next time you insert this disk.""")
         self.transfer_from_folder_size.setText(f"({common.convert_bytes(folder_size)})")
 
     def get_selections(self):
-        """ return: source_folder, dest_folder, copy, recurse, save_selection, ignore_patterns """
+        """ return: source_folder, dest_folder, copy, recurse, save_selection, ignore_patterns, mirror, order """
         source_folder = self.transfer_from_folder_input.text()
         dest_folder = self.transfer_to_folder_input.text()
         # move_flag and copy_flag are tied
@@ -400,7 +578,10 @@ the next time you insert this disk.""")
         total_widgets = self.grid_layout.count()
         ignore_patterns = {item_at(i).widget().text() for i in range(total_widgets) if item_at(i).widget().isChecked()}
 
-        return source_folder, dest_folder, operation, recurse, save_selection, ignore_patterns
+        mirror = self.mirror.isChecked()
+        order = self.order.currentData()
+
+        return source_folder, dest_folder, operation, recurse, save_selection, ignore_patterns, mirror, order
 
     def populate_from_settings(self, disk_name):
 
@@ -416,6 +597,8 @@ the next time you insert this disk.""")
             self.copy_flag.setChecked(copy)
             self.move_flag.setChecked(not copy)
             self.recurse.setChecked(inserted_disk.get("recurse", True))
+            self.mirror.setChecked(inserted_disk.get("mirror", False))
+            self.order.setCurrentIndex(max(0, self.order.findData(inserted_disk.get("order", asfaUtils.QUEUE_ORDER))))
             self.remember_disk_option.setChecked(inserted_disk.get("save", True))
         else:
             # raise errors if path does not exist
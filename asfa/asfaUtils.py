@@ -2,20 +2,97 @@ __author__ = "Ondieki"
 __email__ = "ondieki.codes@gmail.com"
 
 import uuid
+import json
+import hashlib
 import time
 import socket
 import struct
 import os
+import math
+import queue
+import threading
+import shutil
+import heapq
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait
 from psutil import disk_partitions
 from send2trash import TrashPermissionError, send2trash
 from filestat import copystat, _samefile
+import fastcopy
 from PyQt5.QtCore import QRunnable, QThread, pyqtSlot
 import common
-from config import Settings
+from config import Settings, Store, Manifest
 
 utils_logger = common.logging.getLogger(__name__)
 utils_logger.info(f">>> Initialized {__name__}")
 
+# max transfers running at once for every (source device, destination device) pair
+TRANSFERS_PER_DEVICE = 1
+# order of transfers waiting for their device pair, one of `QUEUE_ORDERS`
+QUEUE_ORDER = "fifo"
+# files smaller than this (bytes) are packed into `TransferBatch`es of up to
+# `BATCH_MAX_FILES` files or `BATCH_MAX_SIZE` bytes
+BATCH_FILE_SIZE = 1048576
+BATCH_MAX_FILES = 256
+BATCH_MAX_SIZE = 16777216
+# clone files instead of copying them, where the filesystem can (copy-on-write)
+REFLINK = 1
+# copy only the data of sparse files, their holes stay holes, for files missing this many bytes (or more) on disk
+SPARSE_FILES = 1
+SPARSE_MIN_HOLE = 1048576
+# files this big (bytes) copied between devices through python (verify mode, or no in-kernel copy method)
+# are read and written on separate threads, through a ring of `PIPELINE_BUFFERS` buffers,
+# so both devices are busy at once
+PIPELINE_TRANSFERS = 1
+PIPELINE_MIN_SIZE = 8388608
+PIPELINE_BUFFERS = 4
+# files this big (bytes) are copied as `SEGMENTS` byte ranges in parallel
+SEGMENTED_COPY_SIZE = 1073741824
+SEGMENTS = 4
+# copy block size limits (bytes), tuned per device pair between these
+MIN_BLOCK_SIZE = 65536
+MAX_BLOCK_SIZE = 16777216
+# blocks slower than this (seconds) make cancel and progress sluggish
+MAX_BLOCK_LATENCY = 0.5
+# keep incomplete files this big (bytes) and continue them on the next transfer
+RESUME_TRANSFERS = 1
+RESUME_MIN_SIZE = 67108864
+# bytes before the resume offset compared between source and destination
+RESUME_CHECK_SIZE = 1048576
+# bytes copied between resume journal updates, the data is flushed to the device before each
+RESUME_JOURNAL_SIZE = 67108864
+# hash data while copying, then read the destination back and compare
+VERIFY_TRANSFERS = 0
+# 'crc32' (fast) or a hashlib name, e.g. 'sha256'
+VERIFY_HASH = "crc32"
+# what makes an existing destination file a duplicate of the source, each level adds to the previous:
+# 'size', 'mtime' (same modification time), 'partial' (same sampled contents), 'full' (same contents)
+DUPLICATE_CHECK = "mtime"
+# bytes compared at the start, middle and end of files for a 'partial' check
+PARTIAL_CHECK_SIZE = 65536
+# FAT/exFAT store modification times in 2 second steps
+MTIME_TOLERANCE = 2
+# filesystems that allocate space natively; elsewhere preallocating means writing zeros
+PREALLOCATE_FILESYSTEMS = {"ext4", "xfs", "btrfs", "f2fs", "bcachefs", "ntfs3", "tmpfs", "NTFS", "ReFS"}
+# files this big (bytes) are preallocated, and dropped from the page cache once copied
+PREALLOCATE_MIN_SIZE = 1048576
+DROP_CACHE_MIN_SIZE = 8388608
+# largest file (bytes) each filesystem can hold, bigger files are skipped
+FILE_SIZE_LIMITS = {"vfat": 4294967295, "msdos": 4294967295, "FAT": 4294967295, "FAT32": 4294967295}
+# copy extended attributes, except onto filesystems that can't store them
+COPY_XATTRS = 1
+NO_XATTR_FILESYSTEMS = {"vfat", "msdos", "exfat", "FAT", "FAT32", "exFAT"}
+# seconds of throughput the transfer rate is averaged over
+RATE_WINDOW = 3
+# when copied data is flushed to the device, one of `DURABILITY_MODES`:
+# 'none' (left to the OS), 'file' (fsync every file before it's renamed into place),
+# 'periodic' (sync a device every `DURABILITY_SYNC_SIZE` bytes copied to it, and at the end),
+# 'end' (sync every destination device once, when all transfers are done)
+# where devices can't be synced as a whole (Windows), 'periodic' and 'end' work like 'file', see `durability`
+DURABILITY_MODES = ("none", "file", "periodic", "end")
+DURABILITY = "none"
+DURABILITY_SYNC_SIZE = 268435456
+
 
 def isRemovable(path: str):
     """ returns True if path (e.g. G:\\) is removable """
@@ -139,6 +216,8 @@ class DeviceListener(QThread):
 
     def _on_change(self, drives: list):
         """ emit signal of new disks """
+        # a new drive may reuse the device id of the one it replaced
+        forget_devices()
         self.signals.on_change.emit(self.disks)
 
     def close(self):
@@ -152,20 +231,213 @@ class DeviceListener(QThread):
         del self
 
 
+class BlockSizer():
+    """
+    tune the block size of one transfer from measured throughput and syscall latency
+    the block size doubles while throughput keeps improving, then settles
+    parameters:
+        `key`: str device pair the learned size is saved under
+        `length`: int starting block size, `MIN_BLOCK_SIZE` if None
+    """
+    __slots__ = ("key", "length", "best_length", "best_rate", "probing", "_bytes", "_time", "_blocks")
+
+    # learned block size per device pair
+    learned = Store("blocksizes.json")
+
+    def __init__(self, key, length=None):
+        self.key = key
+        self.length = length = MIN_BLOCK_SIZE if length is None else length
+        self.best_length = length
+        self.best_rate = 0
+        self.probing = 1
+        self._bytes = 0
+        self._time = 0
+        self._blocks = 0
+
+    @classmethod
+    def for_transfer(cls, src, dst):
+        """ sizer starting from what was learned for these devices """
+        key = device_pair_name(src, dst)
+        return cls(key, cls.learned.get(key, MIN_BLOCK_SIZE))
+
+    def update(self, n, elapsed):
+        """ record a block of `n` bytes that took `elapsed` seconds """
+        self._bytes += n
+        self._time += elapsed
+        self._blocks += 1
+        # judge a few blocks at a time, single blocks are noisy
+        if self._blocks < 4 or self._time < 0.05:
+            return
+        rate = self._bytes / self._time
+        latency = self._time / self._blocks
+        self._bytes = self._time = self._blocks = 0
+
+        if latency > MAX_BLOCK_LATENCY and self.length > MIN_BLOCK_SIZE:
+            self.length //= 2
+            self.best_length = self.length
+            self.probing = 0
+        elif self.probing:
+            if rate > self.best_rate * 1.1:
+                self.best_rate, self.best_length = rate, self.length
+                if self.length < MAX_BLOCK_SIZE:
+                    self.length *= 2
+                else:
+                    self.probing = 0
+            else:
+                # bigger blocks did not pay off, step back
+                self.length = self.best_length
+                self.probing = 0
+
+    def save(self):
+        """ remember the tuned size for the next transfer on these devices """
+        # still probing, let the next transfer carry on from here
+        self.learned.set(self.key, self.length if self.probing else self.best_length)
+
+
+class RateEstimator():
+    """
+    moving average of throughput per device pair, for a live ETA
+    pairs start from the rate measured on their last transfer
+    parameters:
+        `window`: float seconds the rates are averaged over, `RATE_WINDOW` if None
+    """
+    __slots__ = ("window", "rates", "sizes", "done", "copied", "names", "current", "peak", "_total", "_time")
+
+    # bytes/s per device pair name
+    history = Store("rates.json")
+
+    def __init__(self, window=None):
+        self.window = RATE_WINDOW if window is None else window
+        # device pair: bytes/s
+        self.rates = {}
+        # device pair: bytes queued, bytes of finished workers, bytes transferred at the last sample
+        self.sizes = {}
+        self.done = {}
+        self.copied = {}
+        # device pair: name in `history`, for pairs measured in this transfer
+        self.names = {}
+        # bytes/s of all pairs together
+        self.current = 0
+        self.peak = 0
+        self._total = 0
+        self._time = time.monotonic()
+
+    def add(self, pair, size, src, dst):
+        """ `size` more bytes queued from `src` to `dst` on device pair `pair` """
+        if pair not in self.sizes:
+            name = self.names[pair] = device_pair_name(src, dst)
+            rate = self.history.get(name)
+            if rate:
+                self.rates[pair] = rate
+        self.sizes[pair] = self.sizes.get(pair, 0) + size
+
+    def finish(self, pair, size):
+        """ a worker of `size` bytes on `pair` has nothing left to transfer """
+        self.done[pair] = self.done.get(pair, 0) + size
+
+    def sample(self, running: dict, total: int):
+        """
+        update the averages
+        `running`: device pair: bytes transferred by its unfinished workers
+        `total`: bytes transferred by all workers
+        """
+        now = time.monotonic()
+        elapsed = now - self._time
+        if elapsed <= 0:
+            return
+        # weight of this sample, older ones fade over `window` seconds
+        weight = 1 - math.exp(-elapsed / self.window)
+        # idle pairs keep their rate
+        for pair in running.keys() | self.done.keys():
+            copied = self.done.get(pair, 0) + running.get(pair, 0)
+            if pair not in self.copied:
+                # first sample, nothing to compare with
+                self.copied[pair] = copied
+                continue
+            if copied == self.copied[pair] and pair not in running:
+                continue
+            rate = (copied - self.copied[pair]) / elapsed
+            self.copied[pair] = copied
+            old = self.rates.get(pair)
+            self.rates[pair] = rate if old is None else old + weight * (rate - old)
+        rate = max(0, total - self._total) / elapsed
+        # start from the first sample rather than from 0
+        self.current = rate if not self.peak else self.current + weight * (rate - self.current)
+        self.peak = max(self.peak, self.current)
+        self._total = total
+        self._time = now
+
+    def eta(self) -> float:
+        """ seconds left, pairs transfer in parallel; -1 if unknown """
+        eta = 0
+        for pair, size in self.sizes.items():
+            left = size - self.copied.get(pair, 0)
+            if left <= 0:
+                continue
+            rate = self.rates.get(pair)
+            if not rate:
+                return -1
+            eta = max(eta, left / rate)
+        return eta
+
+    def save(self):
+        """ remember the measured rates for the next transfer on these devices """
+        for pair, copied in self.copied.items():
+            rate = self.rates.get(pair)
+            if copied and rate:
+                self.history.data[self.names[pair]] = rate
+        self.history.save()
+
+
+class TransferCounters():
+    """
+    shared byte counters, one slot per transfer job
+    workers write their own slot as they copy, the UI timer samples
+    the slots instead of receiving a signal for every copied block
+    finished jobs are added to `finished` and their slots reused
+    """
+    __slots__ = ("values", "free", "finished")
+
+    def __init__(self):
+        self.values = array("q")
+        # slots of finished jobs
+        self.free = []
+        # bytes of finished jobs
+        self.finished = 0
+
+    def add(self) -> int:
+        """ create a slot for a new job, return its index """
+        if self.free:
+            slot = self.free.pop()
+            self.values[slot] = 0
+            return slot
+        self.values.append(0)
+        return len(self.values) - 1
+
+    def remove(self, slot, size):
+        """ job in `slot` is done, count all its `size` bytes as copied """
+        self.finished += size
+        self.values[slot] = 0
+        self.free.append(slot)
+
+
 class TransferSignals(common.QObject):
     """
     Defines the signals available from a running worker thread.
     Supported signals are:
     finished
     `str` transfer id
-    progress
-    `int` indicating % progress
+    duplicate
+    `str` destination file that already exists
+    written
+    `str` transfer id, `str` source file, `str` destination file, `str` digest of the copied data
+    (verify mode only, once the file's stats are copied)
+    progress is not signalled, see `TransferCounters`
     """
     __slots__ = ()
     finished = common.pyqtSignal(str)
-    progress = common.pyqtSignal(str, int)
-    transferred = common.pyqtSignal(str, float)
     duplicate = common.pyqtSignal(str)
+    written = common.pyqtSignal(str, str, str, str)
 
 
 class Transfer(QRunnable):
@@ -179,12 +451,15 @@ class Transfer(QRunnable):
         `dst`: str file/dir path
         `size`: float `src` file size in bytes
         `task`: str copy or move
+        `manifest`: `config.Manifest` to record copied files in, for mirroring
     """
     __slots__ = (
         "src", "dst", "size", "model", "task",
-        "index", "signals", "running", "job_id")
+        "index", "signals", "running", "job_id",
+        "counters", "slot", "base", "offset", "verify", "digest", "items", "manifest",
+        "metadata", "moved", "unverified", "sparse", "journal", "checkpoint")
 
-    def __init__(self, src, dst, size, task="copy"):
+    def __init__(self, src, dst, size, task="copy", manifest=None):
         super().__init__()
         self.setAutoDelete(True)
         self.src = src
@@ -192,169 +467,1025 @@ class Transfer(QRunnable):
         self.size = size
         self.task = task
         self.signals = TransferSignals()
-        self.running = 0
+        # cleared to cancel
+        self.running = 1
         # Give this job a unique ID.
         self.job_id = str(uuid.uuid4())
+        # bytes copied so far, in a slot shared with the manager
+        self.counters = array("q", [0])
+        self.slot = 0
+        # bytes of earlier files in the same job
+        self.base = 0
+        # bytes at the start of the destination known to be copied
+        self.offset = 0
+        # hash algorithm to verify with, empty to skip verification
+        self.verify = VERIFY_HASH if VERIFY_TRANSFERS else ""
+        self.digest = ""
+        # (src, dst, size) of every file in this job
+        self.items = ((src, dst, size), )
+        self.manifest = manifest
+        # (src, dst) of copied files waiting for their stats, (src, whether to delete it) of moved files,
+        # (src, dst, digest) of copied files to read back, handled together once the data is copied
+        self.metadata = []
+        self.moved = []
+        self.unverified = []
+        # the file being copied has holes
+        self.sparse = False
+        # destination whose resume journal is kept, and the offset to update it at
+        self.journal = None
+        self.checkpoint = math.inf
+
+    @property
+    def resumable(self) -> bool:
+        """ keep the incomplete destination on cancel/error, to resume later """
+        return RESUME_TRANSFERS and self.size >= RESUME_MIN_SIZE
+
+    def track(self, counters: TransferCounters):
+        """ publish progress in a slot of `counters` """
+        self.counters = counters.values
+        self.slot = counters.add()
 
     @pyqtSlot()
     def run(self):
-        # run the specified function
-        if self.task == "copy":
-            utils_logger.debug(f"Copying files to '{self.dst}'")
-            self.copy(self.src, self.dst)
-        elif self.task == "move":
-            utils_logger.debug(f"Moving files to '{self.dst}'")
-            self.move(self.src, self.dst)
-
-    def _copyfileobj_readinto(self, fsrc, fdst, length=1048576):
+        try:
+            self.transfer(self.src, self.dst)
+        finally:
+            self.finish_files()
+            # always report back, the scheduler waits for `finished`
+            self.running = 0
+            self.signals.finished.emit(self.job_id)
+
+    def transfer(self, src, dst):
+        """ run the specified function, errors are logged """
+        try:
+            if self.task == "copy":
+                utils_logger.debug(f"Copying files to '{dst}'")
+                self.copy(src, dst)
+            elif self.task == "move":
+                utils_logger.debug(f"Moving files to '{dst}'")
+                self.move(src, dst)
+        except Exception as e:
+            utils_logger.error(f"Transfer failed: {str(e)}")
+
+    def _copyfileobj_readinto(self, fsrc, fdst, length=1048576, sizer=None, hasher=None):
         """
         readinto()/memoryview()-based variant of copyfileobj()
         *fsrc* must support readinto() method and both files must be
         open in binary mode.
+        the block size follows `sizer`, and data is fed to `hasher`, if given
         """
         utils_logger.debug(f"Transferring, method: readinto, buffer: {length}")
-        progress = 0
-        self.running = 1
+        progress = self.offset
         # localize variable access to minimize overhead
         fsrc_readinto = fsrc.readinto
         fdst_write = fdst.write
-        with memoryview(bytearray(length)) as mv:
+        counters, slot, base = self.counters, self.slot, self.base
+        perf_counter = time.perf_counter
+        mv = memoryview(bytearray(length))
+        try:
+            while 1:
+                if sizer is not None and sizer.length != length:
+                    # re-tuned, resize the buffer
+                    length = sizer.length
+                    mv.release()
+                    mv = memoryview(bytearray(length))
+                started = perf_counter()
+                n = fsrc_readinto(mv)
+                if not n:
+                    utils_logger.debug("Successful transfer")
+                    return 1
+
+                elif n < length:
+                    with mv[:n] as smv:
+                        fdst.write(smv)
+                        if hasher is not None:
+                            hasher.update(smv)
+                else:
+                    fdst_write(mv)
+                    if hasher is not None:
+                        hasher.update(mv)
+                if sizer is not None:
+                    sizer.update(n, perf_counter() - started)
+                progress += n
+                counters[slot] = base + progress
+                if progress >= self.checkpoint:
+                    self._checkpoint(fdst, progress)
+                # handle cancel
+                if not self.running:
+                    utils_logger.debug("Cancelled transfer")
+                    return 0
+        except Exception as e:
+            utils_logger.error(f"Error in transferring: {str(e)}")
+            return 0
+        finally:
+            mv.release()
+            self.offset = progress
+
+    def _copyfileobj_pipelined(self, fsrc, fdst, length=1048576, buffers=None, sizer=None, hasher=None):
+        """
+        readinto()/write() variant of copyfileobj() with reads and writes overlapped
+        a reader thread fills a ring of `buffers` (`PIPELINE_BUFFERS` if None) preallocated buffers
+        while this thread writes the filled ones, in order, and feeds `hasher`, if given
+        the buffer size follows `sizer`, timed on the writes
+        """
+        buffers = PIPELINE_BUFFERS if buffers is None else buffers
+        utils_logger.debug(f"Transferring, method: pipelined, buffers: {buffers}, buffer: {length}")
+        progress = self.offset
+        fdst_write = fdst.write
+        counters, slot, base = self.counters, self.slot, self.base
+        perf_counter = time.perf_counter
+        # empty buffers for the reader; (buffer, bytes read) for the writer
+        empty, filled = queue.Queue(), queue.Queue()
+        for _ in range(buffers):
+            empty.put(bytearray(length))
+        errors = []
+
+        def read():
+            fsrc_readinto = fsrc.readinto
+            try:
+                while self.running:
+                    buff = empty.get()
+                    if buff is None:
+                        # the writer stopped
+                        return
+                    n = fsrc_readinto(buff)
+                    filled.put((buff, n))
+                    if not n:
+                        return
+            except Exception as e:
+                errors.append(e)
+            # cancelled or failed, wake the writer up
+            filled.put((None, 0))
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while 1:
+                buff, n = filled.get()
+                if buff is None:
+                    if errors:
+                        raise errors[0]
+                    utils_logger.debug("Cancelled transfer")
+                    return 0
+                if not n:
+                    utils_logger.debug("Successful transfer")
+                    return 1
+                started = perf_counter()
+                with memoryview(buff) as mv, mv[:n] as smv:
+                    fdst_write(smv)
+                    if hasher is not None:
+                        hasher.update(smv)
+                if sizer is not None:
+                    sizer.update(n, perf_counter() - started)
+                    if sizer.length != len(buff):
+                        # re-tuned, the ring is resized a buffer at a time
+                        buff = bytearray(sizer.length)
+                empty.put(buff)
+                progress += n
+                counters[slot] = base + progress
+                if progress >= self.checkpoint:
+                    self._checkpoint(fdst, progress)
+                # handle cancel
+                if not self.running:
+                    utils_logger.debug("Cancelled transfer")
+                    return 0
+        except Exception as e:
+            utils_logger.error(f"Error in transferring: {str(e)}")
+            return 0
+        finally:
+            # a reader waiting for a buffer stops here
+            empty.put(None)
+            reader.join()
+            self.offset = progress
+
+    def _copyfileobj_kernel(self, fsrc, fdst, length=1048576, sizer=None):
+        """
+        copy_file_range()/sendfile()-based variant of copyfileobj()
+        data never enters python; both files must be regular files
+        return None if no kernel method works for these files,
+        so that the caller can fall back to readinto()
+        the chunk size follows `sizer`, if given
+        """
+        start = progress = self.offset
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        counters, slot, base = self.counters, self.slot, self.base
+        perf_counter = time.perf_counter
+        for method in fastcopy.KERNEL_METHODS:
+            utils_logger.debug(f"Transferring, method: {method.__name__}, chunk: {length}")
             try:
                 while 1:
-                    n = fsrc_readinto(mv)
+                    if sizer is not None:
+                        length = sizer.length
+                    started = perf_counter()
+                    n = method(infd, outfd, length)
                     if not n:
-                        self.signals.finished.emit(self.job_id)
-                        self.running = 0
+                        if progress == start:
+                            # some filesystems report 0 instead of an error
+                            break
                         utils_logger.debug("Successful transfer")
                         return 1
 
-                    elif n < length:
-                        with mv[:n] as smv:
-                            fdst.write(smv)
-                    else:
-                        fdst_write(mv)
+                    if sizer is not None:
+                        sizer.update(n, perf_counter() - started)
                     progress += n
-                    percentage = (progress * 100) / self.size
-                    self.signals.transferred.emit(self.job_id, progress)
-                    self.signals.progress.emit(self.job_id, percentage)
+                    counters[slot] = base + progress
+                    if progress >= self.checkpoint:
+                        self._checkpoint(fdst, progress)
                     # handle cancel
                     if not self.running:
                         utils_logger.debug("Cancelled transfer")
-                        self.signals.progress.emit(self.job_id, 100)
-                        self.signals.finished.emit(self.job_id)
                         return 0
-            except Exception as e:
+            except OSError as e:
+                if progress == start and fastcopy.unsupported(e):
+                    # nothing written yet, try the next method
+                    continue
                 utils_logger.error(f"Error in transferring: {str(e)}")
-                self.running = 0
-                self.signals.progress.emit(self.job_id, 100)
-                self.signals.finished.emit(self.job_id)
                 return 0
+            finally:
+                self.offset = progress
 
-    def _copyfileobj(self, fsrc, fdst, length=1048576):
+    def _copyfileobj_segmented(self, fsrc, fdst, segments=None, length=1048576):
         """
-        copy data from file-like object fsrc to file-like object fdst
-        return 1 on success, 0 otherwise
+        pread()/pwrite()-based variant of copyfileobj() for big files
+        the destination is preallocated and `segments` (`SEGMENTS` if None) byte ranges
+        are copied in parallel, progress of all segments is merged into this job's counter
         """
-        utils_logger.debug(
-            f"Transferring, method: copy-buffer, buffer: {length}")
-        progress = 0
-        self.running = 1
-        # localize variables to avoid overhead
-        fsrc_read = fsrc.read
-        fdst_write = fdst.write
+        segments = SEGMENTS if segments is None else segments
+        utils_logger.debug(f"Transferring, method: segmented, segments: {segments}, buffer: {length}")
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = self.size
+        step = -(-size // segments)
+        # bytes done per segment, each thread updates its own slot
+        copied = [0] * segments
+        # set by a failing segment, to stop the others
+        failed = []
+
+        def copy_segment(i):
+            offset = i * step
+            end = min(offset + step, size)
+            try:
+                while offset < end and self.running and not failed:
+                    n = fastcopy.pcopy(infd, outfd, offset, min(length, end - offset))
+                    if not n:
+                        # source shrank while copying
+                        failed.append(i)
+                        return 0
+                    offset += n
+                    copied[i] += n
+            except Exception:
+                failed.append(i)
+                raise
+            return offset >= end
+
         try:
-            while 1:
-                buff = fsrc_read(length)
-                if not buff:
-                    self.signals.finished.emit(self.job_id)
-                    self.running = 0
-                    # break and return success
-                    utils_logger.debug("Successful transfer")
-                    return 1
-                fdst_write(buff)
-                progress += len(buff)
-                percentage = (progress * 100) / self.size
-                self.signals.transferred.emit(self.job_id, progress)
-                self.signals.progress.emit(self.job_id, percentage)
-                # handle cancel
-                if not self.running:
-                    utils_logger.debug("Cancelled transfer")
-                    self.signals.progress.emit(self.job_id, 100)
-                    self.signals.finished.emit(self.job_id)
-                    return 0
+            # preallocate, segments then write in any order
+            os.ftruncate(outfd, size)
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(copy_segment, i) for i in range(segments)]
+                pending = futures
+                while pending:
+                    pending = wait(pending, timeout=0.2)[1]
+                    self.counters[self.slot] = self.base + sum(copied)
+                    if copied[0] >= self.checkpoint:
+                        # the other segments aren't contiguous, only the first can be resumed
+                        self._checkpoint(fdst, copied[0])
+                # raises the first segment error, if any
+                done = all([f.result() for f in futures])
+        except Exception as e:
+            utils_logger.error(f"Error in transferring: {str(e)}")
+            return 0
+        finally:
+            # only the first segment is contiguous from the start
+            self.offset = copied[0]
 
+        if not (done and self.running):
+            utils_logger.debug("Cancelled transfer")
+            return 0
+        utils_logger.debug("Successful transfer")
+        return 1
+
+    def _copyfileobj_sparse(self, fsrc, fdst, length=1048576):
+        """
+        pread()/pwrite()-based variant of copyfileobj() for sparse files
+        only the data ranges are copied, holes are seeked over and the
+        destination is truncated to size, so it gets the same holes
+        progress counts holes as copied
+        """
+        utils_logger.debug(f"Transferring, method: sparse, buffer: {length}")
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = self.size
+        progress = self.offset
+        counters, slot, base = self.counters, self.slot, self.base
+        try:
+            for start, end in fastcopy.data_extents(infd, progress, size):
+                progress = start
+                while progress < end:
+                    if not self.running:
+                        utils_logger.debug("Cancelled transfer")
+                        return 0
+                    n = fastcopy.pcopy(infd, outfd, progress, min(length, end - progress))
+                    if not n:
+                        # source shrank while copying
+                        return 0
+                    progress += n
+                    counters[slot] = base + progress
+                    if progress >= self.checkpoint:
+                        self._checkpoint(fdst, progress)
+            # a hole at the end has no data range, set the size, unless the source shrank since
+            progress = min(size, os.fstat(infd).st_size)
+            os.ftruncate(outfd, progress)
+            counters[slot] = base + progress
         except Exception as e:
             utils_logger.error(f"Error in transferring: {str(e)}")
-            self.running = 0
-            self.signals.progress.emit(self.job_id, 100)
-            self.signals.finished.emit(self.job_id)
             return 0
+        finally:
+            self.offset = progress
+        utils_logger.debug("Successful transfer")
+        return 1
 
     def _copyfile(self, src, dst):
         """ check if file exists, if same filesystem, else prepare file objects """
-        if file_exists(src, dst):
+        offset = self.resumable and resume_offset(src, dst, self.size)
+        if offset:
+            # an earlier transfer was interrupted, continue it below
+            utils_logger.info(f"Resuming '{dst}' at {offset} bytes")
+
+        elif file_exists(src, dst):
             # end prematurely and return special case 2
             utils_logger.debug(f"File already exists '{dst}'")
             self.signals.duplicate.emit(dst)
-            self.signals.progress.emit(self.job_id, 100)
-            self.signals.finished.emit(self.job_id)
             return 2
 
         elif same_filesystem(src, dst) and self.task == "move":
             utils_logger.debug("Renaming same filesystem file")
 
-            # just rename and return success, 1
-            os.rename(src, dst)
-            self.signals.progress.emit(self.job_id, 100)
-            self.signals.finished.emit(self.job_id)
-            return 1
+            # just rename and return special case 3, nothing is left at the source
+            os.replace(src, dst)
+            return 3
 
-        else:
-            try:
-                # prepare file objects for read/write
-                with open(src, 'rb') as fsrc:
-                    with open(dst, 'wb') as fdst:
-                        if self.size > 0:
-                            return self._copyfileobj_readinto(fsrc, fdst, length=min(1048576, self.size))
-                        # copy files with 0 sizes
-                        return self._copyfileobj(fsrc, fdst)
-            except PermissionError:
-                self.signals.progress.emit(self.job_id, 100)
-                self.signals.finished.emit(self.job_id)
-                return 0
+        # write next to `dst` under a hidden name, `dst` only ever holds complete files
+        part = temp_path(src, dst)
+        if not offset:
+            # Windows won't truncate a hidden file, e.g. one left by a crash
+            fastcopy.hide(part, False)
+        try:
+            # prepare file objects for read/write
+            with open(src, 'rb') as fsrc:
+                with open(part, 'r+b' if offset else 'wb') as fdst:
+                    fastcopy.hide(part)
+                    self.offset = offset
+                    if offset:
+                        fdst.truncate(offset)
+                        fsrc.seek(offset)
+                        fdst.seek(offset)
+                    if self.resumable:
+                        # identify the source, for resuming after a crash
+                        self.journal = dst
+                        self.checkpoint = offset + RESUME_JOURNAL_SIZE
+                        if not offset:
+                            write_journal(src, dst, 0)
+                    self.sparse = (
+                        SPARSE_FILES and fastcopy.HAS_PREAD and self.size > SPARSE_MIN_HOLE
+                        and fastcopy.is_sparse(fsrc.fileno(), SPARSE_MIN_HOLE))
+                    if self._reflink(fsrc, fdst):
+                        done = 1
+                    else:
+                        self._prepare(fsrc, fdst, dst)
+                        done = self._copydata(src, dst, fsrc, fdst)
+                    if done and self.offset < self.size:
+                        # the source shrank since it was planned, drop the preallocated tail
+                        utils_logger.info(f"'{src}' shrank to {self.offset} bytes while copying")
+                        fdst.flush()
+                        os.ftruncate(fdst.fileno(), self.offset)
+                    if done:
+                        self._sync(fdst)
+                    elif self.offset > offset:
+                        # keep what was copied, for the next transfer to continue
+                        self._checkpoint(fdst, self.offset)
+                    self._release(fsrc, fdst)
+            if done:
+                # put the copied file in place, its stats follow in `finish_files`
+                fastcopy.hide(part, False)
+                os.replace(part, dst)
+                self.metadata.append((src, dst))
+            return done
+        except OSError as e:
+            utils_logger.error(f"Cannot transfer '{src}': {e}")
+            return 0
+        finally:
+            self.journal = None
+            self.checkpoint = math.inf
+
+    def _checkpoint(self, fdst, offset):
+        """ flush the first `offset` bytes of the destination to the device, then journal them """
+        self.checkpoint = offset + RESUME_JOURNAL_SIZE
+        if self.journal is None:
+            return
+        try:
+            fdst.flush()
+            fastcopy.datasync(fdst.fileno())
+        except OSError as e:
+            # the journal keeps the last offset known to be on the device
+            utils_logger.error(f"Cannot flush '{self.journal}': {e}")
+            return
+        write_journal(self.src, self.journal, offset)
+
+    def _reflink(self, fsrc, fdst) -> bool:
+        """ clone a whole file within one device, True if done """
+        if not (REFLINK and fastcopy.HAS_REFLINK) or self.offset or self.size < 1:
+            return False
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        dev = os.fstat(infd).st_dev
+        if dev in _no_reflink or dev != os.fstat(outfd).st_dev:
+            return False
+        try:
+            fastcopy.reflink(infd, outfd)
+        except OSError as e:
+            utils_logger.debug(f"Cannot clone file: {e}")
+            if fastcopy.unsupported(e):
+                # don't try again on this filesystem
+                _no_reflink.add(dev)
+            return False
+        utils_logger.debug("Transferred, method: reflink")
+        self.offset = self.size
+        self.counters[self.slot] = self.base + self.size
+        return True
+
+    def _sync(self, fdst):
+        """ flush the copied data to the device, as `DURABILITY` asks """
+        mode = durability()
+        if mode == "file":
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        elif mode == "periodic":
+            fdst.flush()
+            fd = fdst.fileno()
+            if unsynced(os.fstat(fd).st_dev, self.size):
+                utils_logger.debug("Syncing destination device")
+                fastcopy.syncfs(fd)
+
+    def _prepare(self, fsrc, fdst, dst):
+        """ preallocate the destination and tell the kernel we'll read the source once, in order """
+        fastcopy.advise(fsrc.fileno(), "SEQUENTIAL")
+        if self.size >= PREALLOCATE_MIN_SIZE and not self.sparse and filesystem_type(dst) in PREALLOCATE_FILESYSTEMS:
+            fastcopy.preallocate(fdst.fileno(), self.offset, self.size - self.offset)
+
+    def _release(self, fsrc, fdst):
+        """ drop copied pages from the page cache, so a big copy doesn't evict hot data """
+        if self.size >= DROP_CACHE_MIN_SIZE:
+            fdst.flush()
+            # starts writeback of dirty pages, drops the clean ones
+            fastcopy.advise(fdst.fileno(), "DONTNEED")
+            fastcopy.advise(fsrc.fileno(), "DONTNEED")
+
+    def _copydata(self, src, dst, fsrc, fdst):
+        """ copy the file data from the current offsets, with the fastest method that fits """
+        offset = self.offset
+        # slow devices on both ends, keep both busy
+        pipelined = (
+            PIPELINE_TRANSFERS and self.size - offset >= PIPELINE_MIN_SIZE
+            and os.fstat(fsrc.fileno()).st_dev != os.fstat(fdst.fileno()).st_dev)
+        if self.verify:
+            # verify mode streams data through python, to hash it
+            hasher = fastcopy.hasher(self.verify)
+            if offset:
+                # the resumed prefix is part of the digest too
+                fsrc.seek(0)
+                fastcopy.digest_fileobj(hasher, fsrc, offset)
+            sizer = BlockSizer.for_transfer(src, dst)
+            if pipelined:
+                done = self._copyfileobj_pipelined(fsrc, fdst, length=sizer.length, sizer=sizer, hasher=hasher)
+            else:
+                done = self._copyfileobj_readinto(fsrc, fdst, length=sizer.length, sizer=sizer, hasher=hasher)
+            if done:
+                sizer.save()
+                self.digest = hasher.hexdigest()
+            return done
+        if self.sparse:
+            return self._copyfileobj_sparse(fsrc, fdst)
+        if (not offset) and self.size >= SEGMENTED_COPY_SIZE and fastcopy.HAS_PREAD:
+            return self._copyfileobj_segmented(fsrc, fdst)
+        if self.size > MIN_BLOCK_SIZE:
+            # tune the block size for these devices
+            sizer = BlockSizer.for_transfer(src, dst)
+            done = self._copyfileobj_kernel(fsrc, fdst, length=sizer.length, sizer=sizer)
+            if done is None and pipelined:
+                done = self._copyfileobj_pipelined(fsrc, fdst, length=sizer.length, sizer=sizer)
+            elif done is None:
+                done = self._copyfileobj_readinto(fsrc, fdst, length=sizer.length, sizer=sizer)
+            if done:
+                sizer.save()
+            return done
+        if self.size > 0:
+            # small file, a single block
+            done = self._copyfileobj_kernel(fsrc, fdst, length=self.size)
+            if done is None:
+                done = self._copyfileobj_readinto(fsrc, fdst, length=self.size)
+            return done
+        # files with 0 sizes have nothing to copy
+        return 1
 
     def copy(self, src, dst):
         """ rename folders and prepare files for copying """
         if os.path.isdir(dst):
             dst = os.path.join(dst, common._basename(src))
         done = self._copyfile(src, dst)
-        # copy file, then copy file stats
-        self.copy_stat(src, dst)
-        if not done:
-            # clean up incomplete dst file
-
-            utils_logger.debug(f"Deleting incomplete file '{dst}'")
-            delete_file(dst)
+        if done == 1 and self.digest:
+            # read back later, on the verification pool, which commits it to the manifest
+            self.unverified.append((src, dst, self.digest))
+        elif done and self.manifest is not None:
+            # copied or already there
+            self.manifest.commit(src, self.digest)
+        if done == 1:
+            if self.resumable:
+                delete_journal(src, dst)
+        elif not done:
+            if self.resumable and self.offset:
+                # keep incomplete file, the journal says how much of it the next transfer can trust
+                utils_logger.info(f"Keeping incomplete file '{temp_path(src, dst)}' at {self.offset} bytes")
+            else:
+                # clean up incomplete file, `dst` itself was never touched
+                part = temp_path(src, dst)
+                if os.path.exists(part):
+                    utils_logger.debug(f"Deleting incomplete file '{part}'")
+                    delete_file(part)
+                if self.resumable:
+                    delete_journal(src, dst)
         return done
 
     def move(self, src, dst):
         """ copy then delete when done """
         done = self.copy(src, dst)
         # delete only transferred files, leave duplicates alone
-        if done == 1:
-            # delete source file only on success
-            utils_logger.debug(f"File moved. Deleting source file '{src}'")
-            delete_file(src)
-            # try removing folder
-            remove_folder(os.path.dirname(src))
-
-    def copy_stat(self, src, dst):
+        if done == 1 and not self.digest:
+            # delete source file only on success, after its stats are copied
+            # verified copies are deleted by `Verification` instead
+            self.moved.append((src, 1))
+        elif done == 3:
+            # renamed, only its folder may be left to remove
+            self.moved.append((src, 0))
+
+    def finish_files(self):
+        """
+        metadata phase, copy the stats of the copied files then delete the moved sources,
+        and hand the copies to verify to the verification pool
+        """
+        # folder: whether it takes extended attributes
+        xattrs = {}
+        for src, dst in self.metadata:
+            folder = os.path.dirname(dst)
+            if folder not in xattrs:
+                xattrs[folder] = COPY_XATTRS and filesystem_type(folder) not in NO_XATTR_FILESYSTEMS
+            self.copy_stat(src, dst, xattrs=xattrs[folder])
+        self.metadata.clear()
+        for src, dst, digest in self.unverified:
+            self.signals.written.emit(self.job_id, src, dst, digest)
+        self.unverified.clear()
+        folders = {}
+        for src, delete in self.moved:
+            if delete:
+                utils_logger.debug(f"File moved. Deleting source file '{src}'")
+                delete_file(src)
+            folders[os.path.dirname(src)] = None
+        self.moved.clear()
+        # try removing folders, once all their moved files are gone
+        for folder in folders:
+            remove_folder(folder)
+
+    def copy_stat(self, src, dst, xattrs=True):
         try:
-            copystat(src, dst)
+            copystat(src, dst, xattrs=xattrs)
         except Exception as e:
             utils_logger.error(f"Stats error: {e}")
 
 
+class TransferBatch(Transfer):
+    """
+    transfer many small files as a single job
+    one runnable, one signals object and one job id for the whole batch,
+    progress is the total of all its files
+    inherits:
+        Transfer
+    parameters:
+        `items`: list of (src, dst, size) for every file
+        `task`: str copy or move
+        `manifest`: `config.Manifest` to record copied files in, for mirroring
+    """
+    __slots__ = ()
+
+    def __init__(self, items, task="copy", manifest=None):
+        src, dst, _ = items[0]
+        super().__init__(src, dst, sum(item[2] for item in items), task=task, manifest=manifest)
+        self.items = items
+
+    @pyqtSlot()
+    def run(self):
+        total = self.size
+        try:
+            for src, dst, size in self.items:
+                if not self.running:
+                    utils_logger.debug("Cancelled batch")
+                    break
+                # per-file choices (block size, resume...) go by this file
+                self.src, self.dst, self.size = src, dst, size
+                self.offset = 0
+                self.digest = ""
+                self.transfer(src, dst)
+                self.base += size
+                self.counters[self.slot] = self.base
+        finally:
+            self.finish_files()
+            self.size = total
+            self.running = 0
+            self.signals.finished.emit(self.job_id)
+
+
+class VerifySignals(common.QObject):
+    """
+    Supported signals are:
+    finished
+    `str` transfer id
+    failed
+    `str` destination file whose contents don't match the source
+    """
+    __slots__ = ()
+    finished = common.pyqtSignal(str)
+    failed = common.pyqtSignal(str)
+
+
+class Verification(QRunnable):
+    """
+    read a copied file back and compare it to the digest taken while copying
+    runs apart from the transfers, so the next copy overlaps the read-back
+    the source is only deleted (moves) and mirrored (`manifest`) once its copy matches
+    parameters:
+        `job_id`: str id of the transfer that wrote `path`
+        `path`: str copied file
+        `digest`: str digest of the source data
+        `algorithm`: str hash algorithm of `digest`, `VERIFY_HASH` if None
+        `src`: str source file of `path`
+        `task`: str copy or move
+        `manifest`: `config.Manifest` to record the source in, for mirroring
+    """
+    __slots__ = ("job_id", "path", "digest", "algorithm", "src", "task", "manifest", "signals")
+
+    def __init__(self, job_id, path, digest, algorithm=None, src="", task="copy", manifest=None):
+        super().__init__()
+        self.setAutoDelete(True)
+        self.job_id = job_id
+        self.path = path
+        self.digest = digest
+        self.algorithm = algorithm or VERIFY_HASH
+        self.src = src
+        self.task = task
+        self.manifest = manifest
+        self.signals = VerifySignals()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            ok = fastcopy.file_digest(self.path, self.algorithm) == self.digest
+        except Exception as e:
+            utils_logger.error(f"Cannot verify '{self.path}': {e}")
+            ok = 0
+        if not ok:
+            utils_logger.error(f"Verification failed: '{self.path}'")
+            self.signals.failed.emit(self.path)
+        elif self.src:
+            self.accept()
+        self.signals.finished.emit(self.job_id)
+
+    def accept(self):
+        """ the copy matches, mirror or delete its source """
+        if self.manifest is not None:
+            self.manifest.commit(self.src, self.digest)
+        if self.task == "move":
+            utils_logger.debug(f"File moved. Deleting source file '{self.src}'")
+            delete_file(self.src)
+            folder = os.path.dirname(self.src)
+            try:
+                with os.scandir(folder) as entries:
+                    empty = next(entries, None) is None
+            except OSError:
+                empty = False
+            if empty:
+                remove_folder(folder)
+
+
+# sort keys of waiting transfers, ties keep the order they were queued in
+QUEUE_ORDERS = {
+    # as queued, i.e. as found
+    "fifo": lambda worker: 0,
+    # quick visible progress
+    "smallest": lambda worker: worker.size,
+    # long transfers start early, short ones fill in at the end
+    "largest": lambda worker: -worker.size,
+    # by source path, a folder at a time, fewer seeks on spinning disks
+    "locality": lambda worker: worker.src,
+}
+
+
+class FlushSignals(common.QObject):
+    """
+    Supported signals are:
+    finished
+    """
+    __slots__ = ()
+    finished = common.pyqtSignal()
+
+
+class Flush(QRunnable):
+    """
+    write the cached data of the devices holding `paths` to the devices,
+    once all transfers are done, see `DURABILITY`
+    parameters:
+        `paths`: list of folders, one per device
+    """
+    __slots__ = ("paths", "signals")
+
+    def __init__(self, paths):
+        super().__init__()
+        self.setAutoDelete(True)
+        self.paths = paths
+        self.signals = FlushSignals()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            for path in self.paths:
+                utils_logger.info(f"Syncing device of '{path}'")
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        fastcopy.syncfs(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    utils_logger.error(f"Cannot sync '{path}': {e}")
+        finally:
+            self.signals.finished.emit()
+
+
+class TransferScheduler():
+    """
+    start `Transfer` workers on a threadpool, grouped by device
+    at most `per_device` workers run for every (source device, destination device) pair,
+    unrelated pairs run in parallel
+    parameters:
+        `pool`: QThreadPool to run workers on
+        `per_device`: int max workers per device pair, `TRANSFERS_PER_DEVICE` if None
+        `order`: str waiting workers order, a key of `QUEUE_ORDERS`, `QUEUE_ORDER` if None
+    """
+    __slots__ = ("pool", "per_device", "order", "_pending", "_running", "_jobs", "_devices", "_queued", "_started")
+
+    def __init__(self, pool, per_device=None, order=None):
+        self.pool = pool
+        self.per_device = TRANSFERS_PER_DEVICE if per_device is None else per_device
+        self.order = order or QUEUE_ORDER
+        # device pair: heap of (sort key, queued number, waiting worker)
+        self._pending = {}
+        # workers queued so far
+        self._queued = 0
+        # job id: started worker
+        self._started = {}
+        # device pair: number of running workers
+        self._running = {}
+        # job id: device pair
+        self._jobs = {}
+        # folder: device id, avoids a stat per file
+        self._devices = {}
+
+    def device(self, folder) -> int:
+        """ cached device id of `folder` """
+        dev = self._devices.get(folder)
+        if dev is None:
+            dev = self._devices[folder] = device_id(folder)
+        return dev
+
+    def device_pair(self, worker) -> tuple:
+        """ (source device, destination device) of `worker` """
+        return (self.device(os.path.dirname(worker.src)), self.device(worker.dst))
+
+    def submit(self, worker):
+        """ start `worker` now if its device pair has a free slot, else queue it """
+        pair = self.device_pair(worker)
+        self._jobs[worker.job_id] = pair
+        if self._running.get(pair, 0) < self.per_device:
+            self._start(pair, worker)
+        else:
+            self._queued += 1
+            key = QUEUE_ORDERS[self.order](worker)
+            heapq.heappush(self._pending.setdefault(pair, []), (key, self._queued, worker))
+
+    def set_order(self, order):
+        """ change the order of waiting workers, a key of `QUEUE_ORDERS` """
+        if order == self.order or order not in QUEUE_ORDERS:
+            return
+        self.order = order
+        key = QUEUE_ORDERS[order]
+        for pair, queue in self._pending.items():
+            queue = [(key(worker), n, worker) for _, n, worker in queue]
+            heapq.heapify(queue)
+            self._pending[pair] = queue
+
+    def running(self):
+        """ yield (device pair, worker) of started workers """
+        for job_id, worker in self._started.items():
+            yield self._jobs[job_id], worker
+
+    def release(self, job_id):
+        """
+        free the slot held by `job_id` and start the next worker of that pair
+        return the device pair of `job_id`, None if unknown
+        """
+        pair = self._jobs.pop(job_id, None)
+        if pair is None:
+            return None
+        self._started.pop(job_id, None)
+        self._running[pair] -= 1
+        queue = self._pending.get(pair)
+        if queue:
+            self._start(pair, heapq.heappop(queue)[2])
+            if not queue:
+                del self._pending[pair]
+        elif not self._running[pair]:
+            del self._running[pair]
+        return pair
+
+    def forget_devices(self):
+        """ drop the cached device ids, drives may be swapped between transfers """
+        self._devices.clear()
+
+    def clear(self):
+        """ drop all workers that have not started """
+        self._pending.clear()
+        self.pool.clear()
+        self._running.clear()
+        self._jobs.clear()
+        self._started.clear()
+        self._devices.clear()
+
+    def _start(self, pair, worker):
+        self._running[pair] = self._running.get(pair, 0) + 1
+        self._started[worker.job_id] = worker
+        self.pool.start(worker)
+
+
+class PlannerSignals(common.QObject):
+    """
+    signals available from a running `TransferPlanner`
+    supported signals:
+        planned
+        `list` (src, dst folder, size) of files to transfer
+        skipped
+        `list` paths of files that don't fit on the destination
+        error
+        `str` errors of the whole walk, one per line, emitted once when it ends
+    """
+    __slots__ = ()
+    planned = common.pyqtSignal(list)
+    skipped = common.pyqtSignal(list)
+    error = common.pyqtSignal(str)
+
+
+class TransferPlanner(QThread):
+    """
+    walk a folder once and stream the files to transfer, in chunks, while walking
+    so the first files copy before the whole tree is listed
+    parameters:
+        `src_folder`: folder to transfer
+        `dst_folder`: folder to transfer into, as `dst_folder/name of src_folder`
+        `task`: 'copy' or 'move'
+        `recurse`: include subfolders
+        `ignore_patterns`: lower-case extensions to skip, or 'without extensions'
+        `mirror`: only plan files that are new or changed since the last mirror
+        `budget`: bytes free on the destination, files that don't fit are skipped; None for no limit
+        `block_size`: allocation unit of the destination, file sizes are rounded up to it
+        `max_size`: largest file the destination can hold; None for no limit
+    """
+    __slots__ = (
+        "signals", "src_folder", "dst_folder", "task",
+        "recurse", "ignore_patterns", "running", "manifest",
+        "budget", "block_size", "max_size", "errors")
+
+    def __init__(
+            self, src_folder, dst_folder, task="copy", recurse=True, ignore_patterns=None, mirror=False,
+            budget=None, block_size=1, max_size=None):
+        super().__init__()
+        self.signals = PlannerSignals()
+        self.src_folder = src_folder
+        self.dst_folder = dst_folder
+        self.task = task
+        self.recurse = recurse
+        self.ignore_patterns = set(ignore_patterns or ())
+        # cleared to stop walking
+        self.running = 1
+        self.manifest = Manifest(src_folder, dst_folder) if mirror else None
+        self.budget = budget
+        self.block_size = block_size
+        self.max_size = max_size
+        # folders that couldn't be created, reported together
+        self.errors = []
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            self.walk(self.src_folder, destination_folder(self.src_folder, self.dst_folder))
+            if self.running and self.manifest is not None:
+                self.manifest.prune()
+        except Exception as e:
+            utils_logger.error(f"Error planning '{self.src_folder}': {e}")
+            self.errors.append(str(e))
+        if self.errors and self.running:
+            shown = self.errors[:10]
+            if len(self.errors) > len(shown):
+                shown.append(f"and {len(self.errors) - len(shown)} more")
+            self.signals.error.emit("\n".join(shown))
+
+    def walk(self, src_folder, dst):
+        """ list `src_folder` into `dst` with os.scandir, files first then subfolders """
+        # whole subtrees can be moved with a rename, if nothing in them is skipped
+        rename = self.task == "move" and self.recurse and not self.ignore_patterns
+        manifest = self.manifest
+        folders = [(src_folder, dst)]
+        chunk = []
+        skipped = []
+        last = time.monotonic()
+        while folders and self.running:
+            src_folder, dst = folders.pop()
+            if rename and rename_folder(src_folder, dst):
+                # whole subtree moved, nothing to transfer
+                continue
+            try:
+                if not os.path.exists(dst):
+                    os.mkdir(dst)
+            except OSError as e:
+                # skip the subtree, nothing in it can be written
+                utils_logger.error(f"Cannot create '{dst}': {e}")
+                self.errors.append(str(e))
+                continue
+            subfolders = []
+            try:
+                with os.scandir(src_folder) as entries:
+                    for entry in entries:
+                        try:
+                            # skip all links
+                            if entry.is_symlink():
+                                continue
+                            if entry.is_file():
+                                if common.isSysFile(entry.name) or self._ignored(entry.name):
+                                    continue
+                                st = entry.stat()
+                                if manifest is None or manifest.changed(entry.path, st.st_size, st.st_mtime_ns):
+                                    if self._fits(entry.path, os.path.join(dst, entry.name), st.st_size):
+                                        chunk.append((entry.path, dst, st.st_size))
+                                    else:
+                                        skipped.append(entry.path)
+                            elif entry.is_dir() and self.recurse:
+                                subfolders.append((entry.path, os.path.join(dst, entry.name)))
+                        except OSError as e:
+                            utils_logger.error(f"Skipping '{entry.path}': {e}")
+            except OSError as e:
+                utils_logger.error(f"Skipping '{src_folder}': {e}")
+            # pop subfolders in listing order
+            folders.extend(reversed(subfolders))
+            if not self.running:
+                # stopped while listing, nothing more is queued
+                return
+            if len(chunk) >= BATCH_MAX_FILES or (chunk and time.monotonic() - last > 0.1):
+                self.signals.planned.emit(chunk)
+                chunk = []
+                last = time.monotonic()
+        if chunk and self.running:
+            self.signals.planned.emit(chunk)
+        if skipped:
+            utils_logger.info(f"{len(skipped)} files don't fit on the destination")
+            self.signals.skipped.emit(skipped)
+
+    def _fits(self, src, dst, size) -> bool:
+        """ reserve space for `src` of `size` bytes, False if destination file `dst` can't take it """
+        if self.max_size is not None and size > self.max_size:
+            return False
+        # copies already there are skipped, they need no space
+        if self.budget is not None and not file_exists(src, dst):
+            # whole allocation units
+            size = -(-size // self.block_size) * self.block_size
+            if size > self.budget:
+                return False
+            self.budget -= size
+        return True
+
+    def _ignored(self, name) -> bool:
+        if not self.ignore_patterns:
+            return False
+        ext = os.path.splitext(name)[-1] or "without extensions"
+        return ext.lower() in self.ignore_patterns
+
+    def stop(self):
+        """ stop walking, files already emitted are not affected """
+        self.running = 0
+
+
 class ThreadBase(QThread):
     """
     Abstract implementation for `BroadcastUser` and `ReceiveUser`
@@ -454,20 +1585,254 @@ def start_file(filename):
     os.startfile(filename)
 
 
-def file_exists(src, dst) -> bool:
-    """ compare file properties """
+def file_exists(src, dst, check=None) -> bool:
+    """
+    compare file properties
+    True if `dst` already is a copy of `src`, as far as `check` (`DUPLICATE_CHECK` if None) can tell
+    a different `dst` at the same path is not a duplicate, it gets copied over
+    """
+    check = check or DUPLICATE_CHECK
     if os.path.isdir(dst):
         dst = os.path.join(dst, common._basename(src))
-    if os.path.exists(dst):
-        # return (os.path.getsize(src) == os.path.getsize(dst))
+    try:
+        dst_st = os.stat(dst)
+        src_st = os.stat(src)
+    except OSError:
+        return False
+    # cheapest first
+    if src_st.st_size != dst_st.st_size:
+        return False
+    if check == "size":
+        return True
+    if abs(src_st.st_mtime - dst_st.st_mtime) > MTIME_TOLERANCE:
+        return False
+    if check == "mtime":
         return True
-    return False
+    try:
+        sample = PARTIAL_CHECK_SIZE if check == "partial" else 0
+        return fastcopy.same_contents(src, dst, src_st.st_size, sample=sample)
+    except OSError:
+        return False
+
+
+def destination_folder(src_folder, dst_folder) -> str:
+    """ folder a folder transfer of `src_folder` into `dst_folder` writes to """
+    return os.path.join(dst_folder, common._basename(src_folder) or f"Removable Disk ({src_folder[0]})")
+
+
+def transfer_size(src_folder, dst_folder, recurse=True, ignore_patterns=None) -> int:
+    """
+    bytes a folder transfer of `src_folder` into `dst_folder` writes, files already there don't count
+    lists the whole folder, run it off the GUI thread
+    """
+    ignore_patterns = set(ignore_patterns or ())
+    total = 0
+    folders = [(src_folder, destination_folder(src_folder, dst_folder))]
+    while folders:
+        src_folder, dst = folders.pop()
+        try:
+            with os.scandir(src_folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_symlink():
+                            continue
+                        if entry.is_file():
+                            ext = os.path.splitext(entry.name)[-1] or "without extensions"
+                            if common.isSysFile(entry.name) or ext.lower() in ignore_patterns:
+                                continue
+                            if not file_exists(entry.path, os.path.join(dst, entry.name)):
+                                total += entry.stat().st_size
+                        elif entry.is_dir() and recurse:
+                            folders.append((entry.path, os.path.join(dst, entry.name)))
+                    except OSError as e:
+                        utils_logger.error(f"Skipping '{entry.path}': {e}")
+        except OSError as e:
+            utils_logger.error(f"Skipping '{src_folder}': {e}")
+    return total
+
+
+def _source_tag(src) -> str:
+    """ short id of `src`, same-named files from different sources get different temp files """
+    return hashlib.sha1(os.fsencode(src)).hexdigest()[:8]
+
+
+def temp_path(src, dst) -> str:
+    """ hidden name `dst` is written under until its copy of `src` is complete """
+    folder, name = os.path.split(dst)
+    return os.path.join(folder, f".{name}.{_source_tag(src)}.asfa-part")
+
+
+def journal_path(src, dst) -> str:
+    """ hidden resume journal kept next to the incomplete copy of `src` to `dst` """
+    folder, name = os.path.split(dst)
+    return os.path.join(folder, f".{name}.{_source_tag(src)}.asfa-resume")
+
+
+def write_journal(src, dst, offset):
+    """ record how much of `src` has been copied to `dst` """
+    st = os.stat(src)
+    journal = {"src": src, "size": st.st_size, "mtime": st.st_mtime_ns, "offset": offset}
+    path = journal_path(src, dst)
+    # Windows won't truncate a hidden file
+    fastcopy.hide(path, False)
+    try:
+        with open(path, 'w') as file:
+            file.write(json.dumps(journal))
+        fastcopy.hide(path)
+    except OSError as e:
+        utils_logger.error(f"Cannot write resume journal: {e}")
+
+
+def delete_journal(src, dst):
+    try:
+        os.unlink(journal_path(src, dst))
+    except OSError:
+        pass
+
+
+def resume_offset(src, dst, size) -> int:
+    """
+    return the offset to continue an interrupted `src` -> `dst` copy from,
+    or 0 to start over
+    the journal must match `src` and the bytes before the offset must match on both sides
+    the offset is only ever journaled once the data before it is on the device,
+    the size of the incomplete file says nothing, it may be preallocated
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, common._basename(src))
+    part = temp_path(src, dst)
+    try:
+        with open(journal_path(src, dst)) as file:
+            journal = json.loads(file.read())
+        st = os.stat(src)
+        if (journal["src"], journal["size"], journal["mtime"]) != (src, st.st_size, st.st_mtime_ns):
+            # the source changed since
+            return 0
+        offset = min(journal["offset"], os.path.getsize(part), size)
+        if not offset:
+            return 0
+        check = min(RESUME_CHECK_SIZE, offset)
+        with open(src, 'rb') as fsrc, open(part, 'rb') as fdst:
+            fsrc.seek(offset - check)
+            fdst.seek(offset - check)
+            if fsrc.read(check) != fdst.read(check):
+                utils_logger.info(f"Cannot resume '{dst}', copied data does not match")
+                return 0
+        return offset
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def device_id(path) -> int:
+    """ return the device id of `path`, or of its nearest existing parent """
+    while 1:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return -1
+            path = parent
+
+
+_mount_points = {}
+# devices that can't clone files
+_no_reflink = set()
+
+
+def mount_point(path) -> str:
+    """ return the mount point (drive) holding `path` """
+    path = os.path.abspath(path)
+    dev = device_id(path)
+    mount = _mount_points.get(dev)
+    if mount is None:
+        mount = path
+        while not os.path.ismount(mount):
+            parent = os.path.dirname(mount)
+            if parent == mount:
+                break
+            mount = parent
+        _mount_points[dev] = mount
+    return mount
+
+
+_filesystems = {}
+
+
+def filesystem_type(path) -> str:
+    """ return the filesystem type (e.g. 'ext4', 'vfat', 'NTFS') holding `path`, '' if unknown """
+    dev = device_id(path)
+    fstype = _filesystems.get(dev)
+    if fstype is None:
+        mount = mount_point(path)
+        try:
+            fstype = next((p.fstype for p in disk_partitions(all=True) if p.mountpoint == mount), "")
+        except Exception:
+            fstype = ""
+        _filesystems[dev] = fstype
+    return fstype
+
+
+def forget_devices():
+    """ drop what is cached per device id, for when drives are plugged in or out """
+    _mount_points.clear()
+    _filesystems.clear()
+    _no_reflink.clear()
+
+
+def device_pair_name(src, dst) -> str:
+    """ 'source mount point -> destination mount point', to remember things per device pair """
+    return f"{mount_point(src)} -> {mount_point(dst)}"
+
+
+def durability() -> str:
+    """ `DURABILITY` as this platform can do it, every file is synced where devices can't be """
+    if DURABILITY in ("periodic", "end") and not fastcopy.HAS_SYNCFS:
+        return "file"
+    return DURABILITY
+
+
+_unsynced = {}
+_unsynced_lock = threading.Lock()
+
+
+def unsynced(dev, size) -> bool:
+    """ add `size` bytes written to device `dev`, True (and reset) once `DURABILITY_SYNC_SIZE` are unsynced """
+    with _unsynced_lock:
+        size += _unsynced.get(dev, 0)
+        if size >= DURABILITY_SYNC_SIZE:
+            _unsynced.pop(dev, None)
+            return True
+        _unsynced[dev] = size
+        return False
+
+
+def free_space(path) -> tuple:
+    """ (bytes free to this user, allocation unit) on the device holding folder `path` """
+    if hasattr(os, "statvfs"):
+        st = os.statvfs(path)
+        # f_bavail leaves out blocks reserved for root
+        return st.f_bavail * st.f_frsize, st.f_frsize
+    return shutil.disk_usage(path).free, 4096
 
 
 def same_filesystem(src, dst) -> bool:
-    if os.path.commonprefix((src, dst)):
+    """ True if `src` and `dst` (or the folder it will be created in) are on the same device """
+    return device_id(src) == device_id(dst)
+
+
+def rename_folder(src_folder, dst) -> bool:
+    """ move a folder with a single rename, if `dst` is free and on the same device """
+    if os.path.exists(dst) or not same_filesystem(src_folder, dst):
+        return False
+    try:
+        os.rename(src_folder, dst)
+        utils_logger.info(f"Renamed folder '{src_folder}' to '{dst}'")
         return True
-    return False
+    except OSError as e:
+        # e.g. a drive root, fall back to moving file by file
+        utils_logger.debug(f"Cannot rename folder: {e}")
+        return False
 
 
 def delete_file(filename, trash=False):
@@ -542,16 +1907,3 @@ def get_folders(path: str) -> list:
         for folder, subfolders, files in os.walk(path):
             if files:
                 yield folder
-
-
-def get_files_folders(path: str):
-    """ return a sorted list of files first and lastly folders """
-    items = []
-    for entry in os.scandir(path):
-        if entry.is_file():
-            # put files at the beginning
-            items.insert(0, entry.path)
-        else:
-            # put folders at the end
-            items.append(entry.path)
-    return items
@@ -0,0 +1,253 @@
+__author__ = "Ondieki"
+__email__ = "ondieki.codes@gmail.com"
+
+# transfer engine benchmarks, Linux only (tmpfs, a disk folder and loop-mounted FAT images)
+# every run is a separate process, so CPU time and peak RSS are its own
+#
+#   python benchmark.py                        all trees, tasks and targets
+#   python benchmark.py -t tiny -k copy -d fat
+#   python benchmark.py -d disk -D none -D file -D periodic -D end
+#   python benchmark.py --set SEGMENTS=1
+#
+# mounting the FAT image needs root and mkfs.vfat, it's skipped otherwise
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import resource
+import argparse
+import tempfile
+import subprocess
+from ast import literal_eval
+
+
+# name: (number of folders, files per folder, min size, max size), sizes in bytes
+TREES = {
+    "tiny": ((200, 100, 1024, 8192), ),
+    "huge": ((1, 2, 268435456, 268435456), ),
+    "mixed": ((100, 20, 1024, 65536), (10, 5, 1048576, 8388608), (1, 1, 134217728, 134217728)),
+}
+TASKS = ("copy", "move")
+# syncing tmpfs costs nothing, durability shows on 'disk' and 'fat'
+TARGETS = ("tmpfs", "disk", "fat")
+TMPFS = "/dev/shm"
+FAT_IMAGE_SIZE = 2048  # MiB
+BLOCK = 1048576
+
+
+def make_tree(root, tree, scale=1.0, seed=0):
+    """ write the files of `tree` under `root`, return (files, bytes) """
+    rand = random.Random(seed)
+    # contents don't matter to the engine, one random block is enough
+    block = rand.randbytes(BLOCK)
+    files = total = 0
+    for n, (folders, per_folder, low, high) in enumerate(TREES[tree]):
+        for d in range(max(1, int(folders * scale))):
+            folder = os.path.join(root, f"set{n}", f"folder{d}")
+            os.makedirs(folder)
+            for f in range(per_folder):
+                size = rand.randint(low, high)
+                with open(os.path.join(folder, f"file{f}.bin"), 'wb') as file:
+                    left = size
+                    while left:
+                        left -= file.write(block[:min(left, BLOCK)])
+                files += 1
+                total += size
+    return files, total
+
+
+def tree_size(root):
+    """ (files, bytes) found under `root` """
+    files = total = 0
+    for folder, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(folder, name))
+    return files, total
+
+
+def transfer(app, src, dst, task):
+    """ transfer folder `src` into `dst` with the app's own planner and manager, headless """
+    import asfaUtils
+    from asfaGUI import WorkerManager
+
+    manager = WorkerManager()
+    manager.all_done.connect(app.quit)
+    planner = asfaUtils.TransferPlanner(src, dst, task=task)
+    planner.signals.planned.connect(lambda items: [manager.add(*item, task=task) for item in items])
+    manager.plan(planner)
+    app.exec_()
+
+
+def run_once(tree, task, dst_root, scale, settings):
+    """ build `tree`, transfer it into `dst_root` and measure, in this process """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    # start-up isn't measured
+    app = QApplication([])
+    import asfaGUI  # noqa: F401
+    import asfaUtils
+    for name, value in settings.items():
+        setattr(asfaUtils, name, value)
+
+    work = tempfile.mkdtemp(prefix="asfa-bench-", dir=TMPFS)
+    dst = tempfile.mkdtemp(prefix="asfa-bench-", dir=dst_root)
+    # every run starts untuned, and leaves the app's learned block sizes and rates alone
+    for store in (asfaUtils.BlockSizer.learned, asfaUtils.RateEstimator.history):
+        store.filename = os.path.join(work, os.path.basename(store.filename))
+        store.data = {}
+    try:
+        src = os.path.join(work, tree)
+        files, size = make_tree(src, tree, scale)
+        os.sync()
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        transfer(app, src, dst, task)
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+        copied = tree_size(os.path.join(dst, tree))
+        return {
+            "tree": tree, "task": task, "files": files, "bytes": size,
+            "seconds": elapsed,
+            "cpu": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+            "durability": asfaUtils.durability(),
+            # KiB on Linux
+            "peak_rss": after.ru_maxrss * 1024,
+            "complete": copied == (files, size),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        shutil.rmtree(dst, ignore_errors=True)
+
+
+def mount_fat(size):
+    """ format and loop-mount a FAT32 image of `size` MiB, return (image folder, mount point) """
+    folder = tempfile.mkdtemp(prefix="asfa-bench-fat-")
+    image = os.path.join(folder, "fat.img")
+    mount_point = os.path.join(folder, "mnt")
+    os.mkdir(mount_point)
+    with open(image, 'wb') as file:
+        file.truncate(size * 1048576)
+    try:
+        subprocess.run(["mkfs.vfat", "-F", "32", image], check=True, capture_output=True)
+        subprocess.run(
+            ["mount", "-o", f"loop,uid={os.getuid()},gid={os.getgid()}", image, mount_point],
+            check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise RuntimeError(getattr(e, "stderr", b"").decode(errors="replace").strip() or str(e))
+    return folder, mount_point
+
+
+def unmount_fat(folder, mount_point):
+    subprocess.run(["umount", mount_point], capture_output=True)
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def report(target, result) -> str:
+    seconds = max(result["seconds"], 1e-9)
+    return (
+        f"{target:<6} {result['tree']:<6} {result['task']:<5} {result['durability']:<8}"
+        f" {result['files']:>7} {result['bytes'] / 1048576:>9.1f}"
+        f" {result['bytes'] / 1048576 / seconds:>9.1f} {result['files'] / seconds:>9.1f}"
+        f" {result['seconds']:>8.2f} {result['cpu']:>8.2f} {result['peak_rss'] / 1048576:>8.1f}"
+        f"{'' if result['complete'] else '  INCOMPLETE'}"
+    )
+
+
+HEADER = (
+    f"{'target':<6} {'tree':<6} {'task':<5} {'sync':<8} {'files':>7} {'MiB':>9}"
+    f" {'MiB/s':>9} {'files/s':>9} {'wall s':>8} {'cpu s':>8} {'rss MiB':>8}"
+)
+
+
+def parse_setting(text):
+    """ 'NAME=VALUE' to (NAME, VALUE), VALUE as a python literal """
+    name, _, value = text.partition("=")
+    try:
+        value = literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def main():
+    from asfaUtils import DURABILITY_MODES
+
+    parser = argparse.ArgumentParser(description="benchmark asfa file transfers")
+    parser.add_argument("-t", "--tree", action="append", choices=TREES, help="trees to transfer (default: all)")
+    parser.add_argument("-k", "--task", action="append", choices=TASKS, help="tasks to run (default: all)")
+    parser.add_argument("-d", "--target", action="append", choices=TARGETS, help="destinations (default: all)")
+    parser.add_argument(
+        "-D", "--durability", action="append", choices=DURABILITY_MODES,
+        help="DURABILITY modes to compare (default: the app's)")
+    parser.add_argument("--disk-dir", default=tempfile.gettempdir(), help="folder for the 'disk' target")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="multiply the number of folders")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="runs per benchmark")
+    parser.add_argument("--fat-size", type=int, default=FAT_IMAGE_SIZE, help="FAT image size in MiB")
+    parser.add_argument(
+        "--set", action="append", default=[], type=parse_setting, metavar="NAME=VALUE",
+        help="override an asfaUtils setting, e.g. SEGMENTS=1")
+    parser.add_argument("-o", "--output", help="also append the results to this file")
+    # internal: a single measured run, printed as json
+    parser.add_argument("--once", nargs=3, metavar=("TREE", "TASK", "DST"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once:
+        tree, task, dst_root = args.once
+        print(json.dumps(run_once(tree, task, dst_root, args.scale, dict(args.set))))
+        return 0
+
+    if not os.path.isdir(TMPFS):
+        print(f"'{TMPFS}' not found, tmpfs is needed for the source trees", file=sys.stderr)
+        return 1
+
+    lines = [HEADER]
+    print(HEADER, flush=True)
+    if args.set:
+        lines.insert(0, "settings: " + ", ".join(f"{name}={value!r}" for name, value in args.set))
+        print(lines[0], flush=True)
+    for target in args.target or TARGETS:
+        fat = None
+        if target == "fat":
+            try:
+                fat = mount_fat(args.fat_size)
+            except RuntimeError as e:
+                print(f"skipping fat: {e}", file=sys.stderr)
+                continue
+        dst_root = fat[1] if fat else args.disk_dir if target == "disk" else TMPFS
+        try:
+            for tree in args.tree or TREES:
+                for task in args.task or TASKS:
+                    for durability in args.durability or (None, ):
+                        for _ in range(args.repeat):
+                            command = [sys.executable, os.path.abspath(__file__), "--once", tree, task, dst_root,
+                                       "--scale", str(args.scale)]
+                            for name, value in args.set:
+                                command += ["--set", f"{name}={value!r}"]
+                            if durability:
+                                command += ["--set", f"DURABILITY={durability!r}"]
+                            output = subprocess.run(command, capture_output=True, text=True)
+                            if output.returncode:
+                                print(f"{target} {tree} {task} failed:\n{output.stderr}", file=sys.stderr)
+                                continue
+                            line = report(target, json.loads(output.stdout.splitlines()[-1]))
+                            lines.append(line)
+                            print(line, flush=True)
+        finally:
+            if fat:
+                unmount_fat(*fat)
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write("\n".join(lines) + "\n\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
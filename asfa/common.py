@@ -219,6 +219,16 @@ def convert_bytes(num: float) -> str:
         return "NaN"
 
 
+def convert_seconds(num: float) -> str:
+    """ format seconds as a rough duration for presentation """
+    if num < 60:
+        return f"{max(1, round(num))} sec"
+    elif num < 3600:
+        return f"{round(num / 60)} min"
+    else:
+        return f"{int(num // 3600)} hr {round(num % 3600 / 60)} min"
+
+
 def get_files(folder: str):
     """
     return the file and its stats
@@ -2,6 +2,8 @@ __author__ = "Ondieki"
 __email__ = "ondieki.codes@gmail.com"
 
 import json
+import hashlib
+import threading
 from common import logging, _join
 
 
@@ -51,13 +53,104 @@ class Settings():
             config_logger.error("Saved settings keys did not match")
         return False
 
-    def remember_disk(self, disk_name, t_from, t_to, operation, recurse, remember):
+    def remember_disk(self, disk_name, t_from, t_to, operation, recurse, remember, mirror=False, order="fifo"):
         config_logger.info(f"Saving disk ({disk_name}) settings for automation")
 
         new_disk = {"source_folder": t_from,
                     "dest_folder": t_to, "copy": operation,
                     "recurse": recurse, "save": remember,
+                    "mirror": mirror, "order": order,
                     }
 
         self.choices["disks"][disk_name] = new_disk
         self.save()
+
+
+class Store():
+    """
+    small json file of values learned at runtime, e.g. per-device tuning
+    safe to use from several transfer threads
+    parameters:
+        `name`: str file name in the data folder
+    """
+    __slots__ = ("filename", "data", "lock")
+
+    def __init__(self, name):
+        self.filename = _join(name)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        """ update `key` and save, if the value changed """
+        with self.lock:
+            if self.data.get(key) == value:
+                return
+            self.data[key] = value
+        self.save()
+
+    def save(self):
+        with self.lock:
+            try:
+                with open(self.filename, 'w') as file:
+                    file.write(json.dumps(self.data, indent=2))
+            except Exception as e:
+                config_logger.error(f"Cannot save '{self.filename}': {e}")
+
+    def load(self):
+        try:
+            with open(self.filename) as file:
+                self.data = json.loads(file.read())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            config_logger.error(f"{e}")
+
+
+class Manifest(Store):
+    """
+    size, modification time and digest of every file mirrored from a folder,
+    files planned since the last mirror are kept pending until copied
+    parameters:
+        `src_folder`: folder being mirrored
+        `dst_folder`: folder it is mirrored into
+    """
+    __slots__ = ("root", "pending", "seen")
+
+    def __init__(self, src_folder, dst_folder):
+        key = hashlib.sha1(f"{src_folder}|{dst_folder}".encode()).hexdigest()[:16]
+        super().__init__(f"mirror-{key}.json")
+        self.root = src_folder
+        self.pending = {}
+        self.seen = set()
+
+    def _key(self, path) -> str:
+        return path[len(self.root):].lstrip("\\/")
+
+    def changed(self, path, size, mtime) -> bool:
+        """ True if `path` is new or changed since it was last mirrored """
+        key = self._key(path)
+        self.seen.add(key)
+        entry = self.data.get(key)
+        if entry and entry[0] == size and entry[1] == mtime:
+            return False
+        with self.lock:
+            self.pending[key] = [size, mtime, ""]
+        return True
+
+    def commit(self, path, digest=""):
+        """ `path` is in the mirror, as it was when `changed` saw it """
+        key = self._key(path)
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            if entry is not None:
+                entry[2] = digest
+                self.data[key] = entry
+
+    def prune(self):
+        """ forget files not seen since the manifest was loaded, e.g. deleted ones """
+        with self.lock:
+            self.data = {key: entry for key, entry in self.data.items() if key in self.seen}
@@ -0,0 +1,258 @@
+__author__ = "Ondieki"
+__email__ = "ondieki.codes@gmail.com"
+
+# thin wrappers around OS-level copy primitives used by `asfaUtils.Transfer`
+# availability differs per platform; check the flags/tuples before use
+
+import os
+import sys
+import zlib
+import errno
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+try:
+    import ctypes
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (ImportError, OSError, AttributeError, TypeError):
+    # not Linux, or no syncfs in libc
+    _syncfs = None
+
+try:
+    _kernel32 = ctypes.windll.kernel32
+except (NameError, AttributeError, OSError):
+    # not Windows, dot files are hidden
+    _kernel32 = None
+
+
+# errors meaning "this syscall can't copy between these two files",
+# the caller should try the next method instead of failing the transfer
+_FALLBACK_ERRNOS = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+    errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK, errno.ETXTBSY,
+    errno.ENOTTY,
+}
+
+
+HAS_FALLOCATE = hasattr(os, "posix_fallocate")
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+
+
+def preallocate(fd: int, offset: int, count: int):
+    """ reserve `count` bytes from `offset`, so the file is laid out in one piece """
+    if HAS_FALLOCATE and count > 0:
+        try:
+            os.posix_fallocate(fd, offset, count)
+        except OSError:
+            pass
+
+
+def advise(fd: int, advice: str, offset=0, count=0):
+    """ hint the kernel how `fd` will be used, `advice` like 'SEQUENTIAL' or 'DONTNEED' """
+    if HAS_FADVISE:
+        try:
+            os.posix_fadvise(fd, offset, count, getattr(os, f"POSIX_FADV_{advice}"))
+        except OSError:
+            pass
+
+
+def unsupported(err: OSError) -> bool:
+    """ True if `err` means the copy method is unsupported for these files """
+    return err.errno in _FALLBACK_ERRNOS
+
+
+def _copy_file_range(infd: int, outfd: int, count: int) -> int:
+    """ copy up to `count` bytes between file offsets, without leaving the kernel """
+    return os.copy_file_range(infd, outfd, count)
+
+
+def _sendfile(infd: int, outfd: int, count: int) -> int:
+    """ copy up to `count` bytes from `infd` to `outfd` using sendfile() """
+    return os.sendfile(outfd, infd, None, count)
+
+
+# copy-on-write clones, Linux btrfs/XFS/bcachefs... on one filesystem
+FICLONE = 0x40049409
+HAS_REFLINK = fcntl is not None and sys.platform.startswith("linux")
+
+
+def reflink(infd: int, outfd: int):
+    """ make `outfd` share all the data of `infd`, nothing is copied until either changes """
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+
+def datasync(fd: int):
+    """ write the cached data of `fd` to its device, metadata only as far as needed to read it back """
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+FILE_ATTRIBUTE_HIDDEN = 0x2
+
+
+def hide(path, hidden=True):
+    """ set (or clear) the hidden attribute of `path` on Windows, elsewhere a leading dot hides files """
+    if _kernel32 is None:
+        return
+    attributes = _kernel32.GetFileAttributesW(path)
+    if attributes == -1 or attributes == 0xFFFFFFFF:
+        return
+    if hidden:
+        attributes |= FILE_ATTRIBUTE_HIDDEN
+    else:
+        attributes &= ~FILE_ATTRIBUTE_HIDDEN
+    _kernel32.SetFileAttributesW(path, attributes)
+
+
+# whole devices can be synced, not on Windows, where only open files can
+HAS_SYNCFS = _syncfs is not None or hasattr(os, "sync")
+
+
+def syncfs(fd: int):
+    """
+    write all cached data of the filesystem holding `fd` to its device
+    falls back to syncing every filesystem, or only `fd` where that isn't possible (see `HAS_SYNCFS`)
+    """
+    if _syncfs is not None and _syncfs(fd) == 0:
+        return
+    if hasattr(os, "sync"):
+        os.sync()
+    else:
+        os.fsync(fd)
+
+
+# in-kernel copy methods, in order of preference
+KERNEL_METHODS = tuple(
+    method for name, method in (
+        ("copy_file_range", _copy_file_range),
+        ("sendfile", _sendfile),
+    ) if hasattr(os, name)
+)
+
+
+# holes in sparse files can be skipped
+HAS_SEEK_DATA = hasattr(os, "SEEK_DATA") and hasattr(os, "SEEK_HOLE")
+
+
+def is_sparse(fd: int, min_hole=0) -> bool:
+    """ True if the file at `fd` takes over `min_hole` bytes less space than its size """
+    st = os.fstat(fd)
+    return HAS_SEEK_DATA and hasattr(st, "st_blocks") and st.st_blocks * 512 + min_hole < st.st_size
+
+
+def data_extents(fd: int, offset: int, size: int):
+    """ yield (start, end) of every range holding data in the first `size` bytes of `fd`, from `offset` """
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole left
+                return
+            raise
+        if start >= size:
+            return
+        offset = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, min(offset, size)
+
+
+# positional I/O, lets several threads work on one file at once
+HAS_PREAD = hasattr(os, "pread") and hasattr(os, "pwrite")
+
+
+def pcopy(infd: int, outfd: int, offset: int, count: int) -> int:
+    """
+    copy up to `count` bytes at `offset` from `infd` to the same offset in `outfd`
+    return the number of bytes copied, 0 at end of file
+    """
+    buff = os.pread(infd, count, offset)
+    n = len(buff)
+    written = 0
+    with memoryview(buff) as mv:
+        while written < n:
+            written += os.pwrite(outfd, mv[written:], offset + written)
+    return n
+
+
+class _CRC32():
+    """ hashlib-like wrapper around zlib.crc32, fast but not cryptographic """
+    __slots__ = ("value", )
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+def hasher(algorithm: str):
+    """ new hash object for `algorithm`, 'crc32' or any hashlib name e.g. 'sha256' """
+    if algorithm == "crc32":
+        return _CRC32()
+    return hashlib.new(algorithm)
+
+
+def digest_fileobj(hash_obj, fobj, count=-1, length=1048576):
+    """ feed the next `count` bytes of `fobj` (all, if negative) to `hash_obj` """
+    with memoryview(bytearray(length)) as mv:
+        while count:
+            with mv[:length if count < 0 else min(length, count)] as smv:
+                n = fobj.readinto(smv)
+                if not n:
+                    break
+                with smv[:n] as data:
+                    hash_obj.update(data)
+            if count > 0:
+                count -= n
+
+
+def file_digest(path, algorithm: str, length=1048576) -> str:
+    """
+    hash the file at `path` as stored on its device
+    the file is flushed and dropped from the page cache first, where possible,
+    so the bytes are read back from the media and not from memory
+    """
+    with open(path, 'rb') as fobj:
+        fd = fobj.fileno()
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        advise(fd, "DONTNEED")
+        hash_obj = hasher(algorithm)
+        digest_fileobj(hash_obj, fobj, length=length)
+    return hash_obj.hexdigest()
+
+
+def same_contents(path1, path2, size, sample=0, length=1048576) -> bool:
+    """
+    compare the contents of two files of `size` bytes
+    if `sample` is set, only compare `sample` bytes at the start, middle and end
+    """
+    if sample and size > 3 * sample:
+        ranges = ((0, sample), (size // 2, sample), (size - sample, sample))
+    else:
+        ranges = ((0, size), )
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        for offset, count in ranges:
+            f1.seek(offset)
+            f2.seek(offset)
+            while count > 0:
+                n = min(length, count)
+                block = f1.read(n)
+                if block != f2.read(n):
+                    return False
+                if not block:
+                    break
+                count -= n
+    return True
@@ -77,7 +77,7 @@ else:
         pass
 
 
-def copystat(src, dst, *, follow_symlinks=True):
+def copystat(src, dst, *, follow_symlinks=True, xattrs=True):
     """Copy file metadata
 
     Copy the permission bits, last access time, last modification time, and
@@ -88,6 +88,7 @@ def copystat(src, dst, *, follow_symlinks=True):
 
     If the optional flag `follow_symlinks` is not set, symlinks aren't
     followed if and only if both `src` and `dst` are symlinks.
+    If `xattrs` is not set, extended attributes are not copied.
     """
 
     def _nop(*args, ns=None, follow_symlinks=None):
@@ -117,7 +118,8 @@ def copystat(src, dst, *, follow_symlinks=True):
                     follow_symlinks=follow)
     # We must copy extended attributes before the file is (potentially)
     # chmod()'ed read-only, otherwise setxattr() will error with -EACCES.
-    _copyxattr(src, dst, follow_symlinks=follow)
+    if xattrs:
+        _copyxattr(src, dst, follow_symlinks=follow)
     try:
         lookup("chmod")(dst, mode, follow_symlinks=follow)
     except NotImplementedError:
@@ -60,6 +60,8 @@ class Controller(MainWindow):
         self.client_is_busy = ""
         self.transfer_is_busy = ""
         self.last_known_dir = LAST_KNOWN_DIR
+        # folders being sized for a transfer, see `_check_space`
+        self.space_checks = set()
         # get values from the settings tab
         # if no value set, ask the user or use default
         self.username = self.settings_man.username_input.text() or common.USERNAME
@@ -752,15 +754,12 @@ class Controller(MainWindow):
         except IndexError:
             self.center_statusbar_signal.emit("No file selected!")
 
-    def register_worker(self, src, dst, task):
-        """ create and enqueue transfer worker if valid """
-        transfer_worker = asfaUtils.Transfer(
-            src, dst,
-            os.path.getsize(src),
-            task=task
-        )
-        if self.worker_manager.is_valid(transfer_worker):
-            self.worker_manager.enqueue(transfer_worker)
+    def register_worker(self, src, dst, task, size=None, manifest=None):
+        """ queue a file for transfer if valid, small files wait for `worker_manager.flush` """
+        if self.worker_manager.is_valid(src, dst):
+            if size is None:
+                size = os.path.getsize(src)
+            self.worker_manager.add(src, dst, size, task=task, manifest=manifest)
             # prevent system sleep
             if not self.app_is_busy():
                 common.prevent_sleep()
@@ -779,6 +778,7 @@ class Controller(MainWindow):
                 self.register_worker(src, dst, task)
             except Exception:
                 to_delete.add(src)
+        self.worker_manager.flush()
         self.files_model.removeRows(to_delete)
 
     def copy(self):
@@ -822,9 +822,9 @@ class Controller(MainWindow):
     def folder_transfer(self):
         """ handles transfers initiated from quick transfer window """
         try:
-            # source_folder, dest_folder, copy, recurse, save_selection, ignore_patterns
+            # source_folder, dest_folder, copy, recurse, save_selection, ignore_patterns, mirror, order
             choice = self.folder_transfers_win.get_selections()
-            src, dst, copy, isRecursive, save_selection, ignore = choice[0], choice[1], choice[2], choice[3], choice[4], choice[5]
+            src, dst, copy, isRecursive, save_selection, ignore, mirror, order = choice
             if all((src, dst)):
 
                 # hide folders window
@@ -832,55 +832,81 @@ class Controller(MainWindow):
 
                 if save_selection:
                     disk = src[:3] if asfaUtils.isRemovable(src[:3]) else dst[:3]
-                    self.saved_settings.remember_disk(disk, src, dst, copy, isRecursive, save_selection)
+                    self.saved_settings.remember_disk(disk, src, dst, copy, isRecursive, save_selection, mirror, order)
 
-                if copy:
-                    self.worker_manager.transfer_to.setText(f"Copying to '{dst}'")
-                    self._move_folder(src, dst, recurse=isRecursive, ignore_patterns=ignore)
-                else:  # move
-                    self.worker_manager.transfer_to.setText(f"Moving to '{dst}'")
-                    self._move_folder(src, dst, task="move", recurse=isRecursive, ignore_patterns=ignore)
+                self.worker_manager.scheduler.set_order(order)
+
+                self._check_space(src, dst, copy, isRecursive, ignore, mirror)
 
         except Exception:
             self.inform("Folder Transfer Error")
 
-    def _move_folder(self, src_folder, dst_folder, task="copy", recurse=True, ignore_patterns=None):
-        """ copy folder recursively """
-        try:
-            dst_name = common._basename(src_folder) or f"Removable Disk ({src_folder[0]})"
-            dst = os.path.join(dst_folder, dst_name)
-
-            if not os.path.exists(dst):
-                os.mkdir(dst)
-
-            sorted_items = asfaUtils.get_files_folders(src_folder)
-
-            for item in sorted_items:
-
-                try:
-                    # skip all links
-                    if os.path.islink(item):
-                        continue
-                    # if it's a file, file is not a sys file
-                    if os.path.isfile(item) and (not common.isSysFile(item)):
-
-                        ext = os.path.splitext(item)[-1] or "without extensions"
-                        if (ext.lower() in ignore_patterns):
-                            # skip file with patttern
-                            continue
-                        # else, schedule to transfer
-                        self.register_worker(item, dst, task)
-                    elif os.path.isdir(item) and recurse:
-                        # recurse
-                        self._move_folder(item, dst, task=task, recurse=recurse, ignore_patterns=ignore_patterns)
-
-                except Exception as e:
-                    print(e)
-                    self.center_statusbar_signal.emit("Error: skipping")
-                    continue
-
-        except PermissionError:
-            self.inform("Permission to create and write folder denied!\n\nLet's try that again with a different destination folder")
+    def _check_space(self, src, dst, copy, recurse, ignore, mirror):
+        """
+        fit a folder transfer to the free space and file size limit of `dst`, then start it
+        the folder is sized on a thread, the user is asked if it doesn't fit
+        """
+        if not copy and asfaUtils.same_filesystem(src, dst):
+            # files are renamed, no space needed
+            self._start_folder_transfer(src, dst, copy, recurse, ignore, mirror, {})
+            return
+        free, block_size = asfaUtils.free_space(dst)
+        limits = {
+            "budget": free, "block_size": block_size,
+            "max_size": asfaUtils.FILE_SIZE_LIMITS.get(asfaUtils.filesystem_type(dst)),
+        }
+        if mirror:
+            # only new files are copied, the planner trims them if need be
+            self._start_folder_transfer(src, dst, copy, recurse, ignore, mirror, limits)
+            return
+        thread = common.Thread(asfaUtils.transfer_size, src, dst, recurse, ignore)
+        thread.results.connect(lambda needed: self._fit_folder_transfer(needed, src, dst, copy, recurse, ignore, mirror, limits))
+        thread.finished.connect(lambda: self.space_checks.discard(thread))
+        self.space_checks.add(thread)
+        thread.start()
+
+    def _fit_folder_transfer(self, needed, src, dst, copy, recurse, ignore, mirror, limits):
+        """ start a folder transfer of `needed` bytes, if it fits or the user accepts trimming it """
+        free = limits["budget"]
+        if needed > free:
+            confirmation = self.ask(
+                f"'{common._basename(src)}' needs {common.convert_bytes(needed)}, "
+                f"the destination has {common.convert_bytes(free)} free.\n\nTransfer only the files that fit?")
+            if confirmation != QMessageBox.Yes:
+                # doesn't fit, and the user won't trim it
+                return
+        self._start_folder_transfer(src, dst, copy, recurse, ignore, mirror, limits)
+
+    def _start_folder_transfer(self, src, dst, copy, recurse, ignore, mirror, limits):
+        if copy:
+            self.worker_manager.transfer_to.setText(f"Copying to '{dst}'")
+            self._move_folder(src, dst, recurse=recurse, ignore_patterns=ignore, mirror=mirror, **limits)
+        else:  # move
+            self.worker_manager.transfer_to.setText(f"Moving to '{dst}'")
+            self._move_folder(src, dst, task="move", recurse=recurse, ignore_patterns=ignore, **limits)
+
+    def _move_folder(self, src_folder, dst_folder, task="copy", recurse=True, ignore_patterns=None, mirror=False, **limits):
+        """
+        list folder on a thread, its files are queued as they are found
+        `limits`: budget, block_size and max_size of `asfaUtils.TransferPlanner`
+        """
+        planner = asfaUtils.TransferPlanner(
+            src_folder, dst_folder, task=task, recurse=recurse, ignore_patterns=ignore_patterns, mirror=mirror, **limits)
+        planner.signals.planned.connect(lambda items: self._register_planned(planner, items, task))
+        planner.signals.error.connect(self._on_planner_error)
+        self.worker_manager.plan(planner)
+
+    def _register_planned(self, planner, items, task):
+        """ queue a chunk of (src, dst, size) from a folder planner """
+        if not planner.running:
+            # cancelled, chunks emitted before the planner stopped may still arrive
+            return
+        for src, dst, size in items:
+            self.register_worker(src, dst, task, size=size, manifest=planner.manifest)
+
+    def _on_planner_error(self, error):
+        """ `error`: every folder the planner couldn't transfer, one per line """
+        self.inform(f"Some folders were not transferred:\n\n{error}")
 
     # ----------------------- Let's start sharing files ---------------------------------------
 
@@ -1,7 +1,11 @@
 __author__ = "Ondieki"
 __email__ = "ondieki.codes@gmail.com"
 
-import winreg
+try:
+    import winreg
+except ImportError:
+    # not Windows, e.g. when running the benchmarks
+    winreg = None
 
 
 SPEEDY = 1
@@ -12,7 +16,7 @@ def file_type(ext: str):
 
     if not ext:
         return "File"
-    if SPEEDY:
+    if SPEEDY or winreg is None:
         return f"{ext.strip('.').upper()} File"
     try:
         file_class = winreg.QueryValue(winreg.HKEY_CLASSES_ROOT, ext)